@@ -0,0 +1,88 @@
+import time
+import numpy as np
+from scipy.optimize import Bounds, LinearConstraint, milp
+from scipy.sparse import csr_matrix, hstack, identity
+
+
+# 各阶段 MIP 相对间隙, 与 Gurobi 默认 MIPGap 一致
+MIP_REL_GAP = 1e-4
+# 固定前一阶段最优值时的容差
+OBJECTIVE_TOLERANCE = 1e-6
+
+
+class HighsSelection:
+    # 无 Gurobi 许可时的后端: scipy.optimize.milp (HiGHS) 依次求解各目标, 每阶段把前一目标固定在最优值 (字典序多目标)
+    # Gurobi 模型中各目标为 log(1 + 线性式 / 常数), log 单调递增, 各阶段直接优化线性式, 最优解相同
+    # 接口与 CommunicationSweep 一致, sweep_all_windows / rolling_horizon 可直接使用
+    def __init__(self, instance):
+        self.instance = instance
+        num_rows, num_columns = instance.shape
+        self.num_columns = num_columns
+        # 变量依次为 x (车辆), r (覆盖行); 稳定性目标中 z[i] == x[i], 不单独建变量
+        coverage = instance.coverage
+        rows = identity(num_rows, format="csr")
+        self.coverage_constraints = [
+            # 如果探测车辆总数为0，则r应该为0
+            LinearConstraint(hstack([coverage, -rows]), 0, np.inf),
+            # 如果探测车辆总数大于0，则r应该为1
+            LinearConstraint(hstack([coverage, -instance.big_m * rows]), -np.inf, 0),
+        ]
+        self.bandwidth_matrix = hstack([csr_matrix(instance.in_junction.T), csr_matrix((instance.in_junction.shape[1], num_rows))])
+
+        zeros_x, zeros_r = np.zeros(num_columns), np.zeros(num_rows)
+        self.objectives = [
+            # 目标函数 1: 最大化 (加权) 覆盖行数
+            np.concatenate([zeros_x, -instance.row_weights]),
+            # 目标函数 2：最小化通信车辆数
+            np.concatenate([np.ones(num_columns), zeros_r]),
+            # 目标函数 3：最小化重复探测的惩罚
+            np.concatenate([instance.overlap, zeros_r]),
+        ]
+        if instance.previous:
+            # 目标函数 4：最大化连续选中的车辆数
+            stability = np.zeros(num_columns)
+            stability[instance.previous] = -1
+            self.objectives.append(np.concatenate([stability, zeros_r]))
+
+    def start_from(self, vehicle_indices):
+        return self.instance.start_from(vehicle_indices)
+
+    def solve(self, max_communication_num, start=None, time_limit=None):
+        # milp 不支持 MIP start; start 只在期限内没有得到可行解时作为备用解
+        deadline = None if time_limit is None else time.time() + max(time_limit, 0)
+        constraints = self.coverage_constraints + [LinearConstraint(self.bandwidth_matrix, -np.inf, max_communication_num)]
+        integrality = np.ones(len(self.objectives[0]))
+        solution = None
+        for objective in self.objectives:
+            options = {"mip_rel_gap": MIP_REL_GAP}
+            if deadline is not None:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                options["time_limit"] = remaining
+            result = milp(objective, constraints=constraints, integrality=integrality, bounds=Bounds(0, 1), options=options)
+            if result.x is None:
+                break
+            solution = np.round(result.x[:self.num_columns])
+            if result.status != 0:
+                # 超时: 保留当前最好的可行解
+                break
+            constraints = constraints + [LinearConstraint(objective, -np.inf, result.fun + OBJECTIVE_TOLERANCE * max(1, abs(result.fun)))]
+
+        if solution is None and start is not None and self.instance.is_feasible(start, max_communication_num):
+            solution = np.asarray(start, dtype=float)
+        if solution is None:
+            return [0.0] * self.instance.num_vehicles, None
+        return self.instance.expand(solution), solution
+
+    def run(self, communication_nums):
+        solutions, solution_times = [], []
+        start = None
+        for max_communication_num in communication_nums:
+            start_time = time.time()
+            solution, reduced_solution = self.solve(max_communication_num, start)
+            solution_times.append(time.time() - start_time)
+            solutions.append(solution)
+            if reduced_solution is not None:
+                start = reduced_solution
+        return solutions, solution_times
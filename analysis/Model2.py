@@ -1,39 +1,50 @@
 import time
-from tqdm import tqdm
-import gurobipy as gp
-from gurobipy import GRB
+import numpy as np
+from functools import partial
 from utils import read_pickle, write_pickle
+from preprocess.MatrixStore import WindowMatrixStore
+from analysis.ModelSweep import CommunicationSweep, rolling_horizon, sweep_all_windows
+from analysis.HighsSolver import HighsSelection
+from analysis.ModelMatrices import SelectionInstance, as_detection_matrix, coverage_matrix, overlap_coefficients
 
 grids_dict = read_pickle('data/pkl/grids_dict.pkl')
 grids_keys = list(grids_dict.keys())
 
 def previous_vehicle_selection(vehicle_ids, previous_selected_vehicle_ids):
-    previous_vehicle_ids_index = []
-    vehicle_ids = list(vehicle_ids)
-    for vehicle_id in vehicle_ids:
-        if vehicle_id in previous_selected_vehicle_ids:
-            previous_vehicle_ids_index.append(vehicle_ids.index(vehicle_id))
-    return previous_vehicle_ids_index
-
-def optimize_global_vehicle_selection(detection_matrix, in_junction_matrix, previous_vehicle_indices, max_communication_num):
-    num_grids = len(detection_matrix)
-    num_vehicles, num_periods = detection_matrix[0].shape
-    start_time = time.time()
+    previous_selected_vehicle_ids = set(previous_selected_vehicle_ids)
+    return [i for i, vehicle_id in enumerate(vehicle_ids) if vehicle_id in previous_selected_vehicle_ids]
+
+def build_global_vehicle_selection(detection_matrix, in_junction_matrix, previous_vehicle_indices, max_communication_num, presolve=True, backend='gurobi'):
+    detection_matrix = as_detection_matrix(detection_matrix)
+    num_grids, num_vehicles, num_periods = detection_matrix.shape
+
+    # 模型系数, 第 m * num_periods + j 行对应栅格 m 在时间 j; presolve 删除被支配车辆、无法探测的行并合并重复行, 最优解不变
+    instance = SelectionInstance(coverage_matrix(detection_matrix, per_period=True), np.ones(num_grids * num_periods),
+                                 overlap_coefficients(detection_matrix), in_junction_matrix, previous_vehicle_indices, big_m=num_vehicles)
+    if presolve:
+        instance = instance.reduce()
+    # backend: 'gurobi', 或 'highs' (scipy HiGHS, 无需 Gurobi 许可)
+    if backend == 'highs':
+        return HighsSelection(instance)
+    if backend != 'gurobi':
+        raise ValueError(f"Invalid backend:{backend}")
+    import gurobipy as gp
+    from gurobipy import GRB
+    num_rows, num_columns = instance.shape
     model = gp.Model("Global_Vehicle_Selection")
 
     # 决策变量: x[i] 表示车辆 i 是否被选中，共享于所有矩阵
-    x = model.addVars(num_vehicles, vtype=GRB.BINARY, name="x")
+    x = model.addMVar(num_columns, vtype=GRB.BINARY, name="x")
 
-    # 辅助变量: r[m][j] 表示栅格 m 在时间 j 至少有一个车辆探测
-    r = model.addVars(num_grids, num_periods, vtype=GRB.BINARY, name="r")
+    # 辅助变量: r[m][j] 表示栅格 m 在时间 j 至少有一个车辆探测 (约简后为合并行)
+    r = model.addMVar(num_rows, vtype=GRB.BINARY, name="r")
 
     if len(previous_vehicle_indices) > 0:
         # 辅助变量: z[i] 表示车辆 i 是否被连续选中
-        z = model.addVars(num_vehicles, vtype=GRB.BINARY, name="z")
+        z = model.addMVar(num_columns, vtype=GRB.BINARY, name="z")
 
     # 目标函数 1: 最大化覆盖
-    not_detection_penalty = gp.quicksum((1-r[m, j]) for m in range(num_grids) for j in range(num_periods))
-    normalized_not_detection_penalty = not_detection_penalty / num_grids / num_periods
+    normalized_not_detection_penalty = (num_grids * num_periods - instance.row_weights @ r) / num_grids / num_periods
     z1 = model.addVar(name="z1")
     model.addConstr(z1 == normalized_not_detection_penalty + 1)
     log_z1 = model.addVar(name="log_z1")
@@ -41,17 +52,16 @@ def optimize_global_vehicle_selection(detection_matrix, in_junction_matrix, prev
     model.setObjectiveN(100 * log_z1, index=0, priority=3)
 
     # 目标函数 2：最小化通信成本
-    normalized_communication_cost = x.sum() / max_communication_num
+    # z2 == x.sum() / max_communication_num + 1, 两边乘以 max_communication_num, 扫描时只需修改 z2 的系数和右端项
     z2 = model.addVar(name="z2")
-    model.addConstr(z2 == normalized_communication_cost + 1)
+    communication = model.addLConstr(max_communication_num * z2 - gp.quicksum(x.tolist()), GRB.EQUAL, max_communication_num, name="CommunicationCost")
     log_z2 = model.addVar(name="log_z2")
     model.addGenConstrLog(z2, log_z2, "log_communication_cost")
     model.setObjectiveN(100 * log_z2, index=1, priority=2)
 
     # 目标函数 3：最小化重复探测的惩罚
-    overlap_penalty = gp.quicksum(gp.quicksum(x[i] * detection_matrix[m][i, j] for i in range(num_vehicles)) 
-                                  for j in range(num_periods) for m in range(num_grids))
-    normalized_overlap_penalty = overlap_penalty / (num_vehicles * num_periods * num_grids)
+    # x[i] 的系数为车辆 i 的探测次数
+    normalized_overlap_penalty = instance.overlap @ x / (num_vehicles * num_periods * num_grids)
     z3 = model.addVar(name="z3")
     model.addConstr(z3 == normalized_overlap_penalty + 1)
     log_z3 = model.addVar(name="log_z3")
@@ -59,47 +69,44 @@ def optimize_global_vehicle_selection(detection_matrix, in_junction_matrix, prev
     model.setObjectiveN(100 * log_z3, index=2, priority=1)
 
     # 目标函数 4：最大化通信稳定性
-    stability_objective_terms = 0
+    stability = z4 = None
     if len(previous_vehicle_indices) > 0:
-        for i in range(num_vehicles):
-            if i in previous_vehicle_indices:
-                model.addConstr(z[i] == x[i], name=f"Stability_{i}")
-                # stability_objective_terms += z[i]
-                stability_objective_terms += (z[i]/max_communication_num)
+        previous = instance.previous
+        model.addConstr(z[previous] == x[previous], name="Stability")
         z4 = model.addVar(name="z4")
-        model.addConstr(z4 == stability_objective_terms + 1)
+        stability = model.addLConstr(max_communication_num * z4 - gp.quicksum(z[previous].tolist()), GRB.EQUAL, max_communication_num, name="StabilityObjective")
         log_z4 = model.addVar(name="log_z4")
         model.addGenConstrLog(z4, log_z4, "log_stability_objective_terms")
         model.setObjectiveN(-100*log_z4, index=3, priority=0)
 
     # 约束: 每个时间点通信的车辆数量不超过最大通信数
-    for j in range(num_periods):
-        model.addConstr(gp.quicksum(x[i] * in_junction_matrix[i, j] for i in range(num_vehicles)) <= max_communication_num, name=f"Bandwidth_{j}")
+    bandwidth = model.addConstr(instance.in_junction.T @ x <= max_communication_num, name="Bandwidth")
 
     M = num_vehicles
-    # 约束: 尝试确保每个时间点至少有一辆车在探测
-    for m in range(num_grids):
-        for j in range(num_periods):
-            # 如果探测车辆总数为0，则r[m][j]应该为0
-            model.addConstr(gp.quicksum(x[i] * detection_matrix[m][i, j] for i in range(num_vehicles)) >= 1 * r[m, j], name=f"MinCoverageRequire_{m}_{j}")
-            # 如果探测车辆总数大于0，则r[m][j]应该为1
-            model.addConstr(gp.quicksum(x[i] * detection_matrix[m][i, j] for i in range(num_vehicles)) <= M * r[m, j], name=f"MinCoverageActivate_{m}_{j}")
+    # 约束: 尝试确保每个时间点至少有一辆车在探测, 第 m * num_periods + j 行对应 r[m][j]
+    # 如果探测车辆总数为0，则r[m][j]应该为0
+    model.addConstr(instance.coverage @ x >= r, name="MinCoverageRequire")
+    # 如果探测车辆总数大于0，则r[m][j]应该为1
+    model.addConstr(instance.coverage @ x <= M * r, name="MinCoverageActivate")
+
+    return CommunicationSweep(model, instance, x, bandwidth, communication, z2, stability, z4)
+
+def optimize_global_vehicle_selection(detection_matrix, in_junction_matrix, previous_vehicle_indices, max_communication_num, presolve=True, backend='gurobi'):
+    start_time = time.time()
+    sweep = build_global_vehicle_selection(detection_matrix, in_junction_matrix, previous_vehicle_indices, max_communication_num, presolve, backend)
 
     # 求解模型
-    model.optimize()
+    solution, reduced_solution = sweep.solve(max_communication_num)
     used_time = time.time() - start_time
 
-    # model.computeIIS()
-    # model.write("model.ilp")
-
-    if model.status == GRB.OPTIMAL:
-        print("Optimal set of vehicles:", [i for i in range(num_vehicles) if x[i].X > 0.5])
-    elif model.status == GRB.INFEASIBLE:
+    if reduced_solution is not None:
+        print("Optimal set of vehicles:", sweep.instance.vehicles[reduced_solution > 0.5].tolist())
+    else:
         print("Model is infeasible; consider relaxing some constraints.")
 
-    return [x[i].X for i in range(num_vehicles)], used_time
+    return solution, used_time
 
-def optimize_all_window_vehicle_selection(vehicle_ids_list, detection_matrices, in_junction_matrices, window_indices, max_communication_num):
+def optimize_all_window_vehicle_selection(vehicle_ids_list, detection_matrices, in_junction_matrices, window_indices, max_communication_num, backend='gurobi'):
     all_window_best_sol = []
     previous_selected_vehicle_ids = []
     solution_time = []
@@ -108,43 +115,46 @@ def optimize_all_window_vehicle_selection(vehicle_ids_list, detection_matrices,
         detection_matrix = detection_matrices[i]
         in_junction_matrix = in_junction_matrices[i]
         previous_vehicle_indices = previous_vehicle_selection(vehicle_ids, previous_selected_vehicle_ids)
-        window_sol, window_time = optimize_global_vehicle_selection(detection_matrix, in_junction_matrix, previous_vehicle_indices, max_communication_num)
+        window_sol, window_time = optimize_global_vehicle_selection(detection_matrix, in_junction_matrix, previous_vehicle_indices, max_communication_num, backend=backend)
         selected_vehicle_ids = [vehicle_ids[i] for i,x in enumerate(window_sol) if x > 0.5]
         all_window_best_sol.append(selected_vehicle_ids)
         solution_time.append(window_time)
         previous_selected_vehicle_ids = selected_vehicle_ids
     return all_window_best_sol, solution_time
 
+def sweep_all_window_vehicle_selection(vehicle_ids_list, detection_matrices, in_junction_matrices, window_indices, communication_nums, backend='gurobi'):
+    return sweep_all_windows(partial(build_global_vehicle_selection, backend=backend), previous_vehicle_selection, vehicle_ids_list, detection_matrices,
+                             in_junction_matrices, window_indices, communication_nums)
+
+def rolling_horizon_vehicle_selection(vehicle_ids_list, detection_matrices, in_junction_matrices, window_indices, max_communication_num,
+                                      time_limit=None, warm_start=True, backend='gurobi'):
+    return rolling_horizon(partial(build_global_vehicle_selection, backend=backend), vehicle_ids_list, detection_matrices, in_junction_matrices,
+                           window_indices, max_communication_num, time_limit, warm_start)
+
 if __name__ == "__main__":
     detection_radius1 = 20
-    vehicle_ids_list = read_pickle("data/pkl/all_window_vehicle_ids_truth.pkl")
-    detection_matrices = read_pickle(f"data/pkl/{detection_radius1}/detection_matrices_pre_{detection_radius1}.pkl")
-    in_junction_matrices = read_pickle(f"data/pkl/{detection_radius1}/in_junction_matrices_pre_{detection_radius1}.pkl")
+    # 按窗口 mmap 读取, 只加载 window_indices 用到的窗口
+    store = WindowMatrixStore(f"data/pkl/{detection_radius1}/window_matrices_pre_{detection_radius1}")
+    vehicle_ids_list = store.vehicle_ids_list()
+    in_junction_matrices = store.in_junction_matrices()
 
-    detection_matrices = [detection_matrix[:1260, : , :] for detection_matrix in detection_matrices]
+    detection_matrices = store.detection_matrices(grids=slice(None, 1260))
 
     window_indices = [0, 19]
     test_communication_num = list(range(1, 10)) + list(range(10, 50, 5)) + list(range(55, 96, 10))  # 21 samples
     
     # scenario 1
-    windows_best_sols1, windows_sol_times1 = [], []
-    for max_communication_num in tqdm(test_communication_num, desc="Scenario 1"):
-        all_window_best_sol, solution_time = optimize_all_window_vehicle_selection(
-            vehicle_ids_list, detection_matrices, in_junction_matrices, window_indices[:1], max_communication_num)
-        windows_best_sols1.append(all_window_best_sol)
-        windows_sol_times1.append(solution_time)
+    # 每个窗口只构建一次模型, 依次修改 max_communication_num 并以上一次的解热启动
+    windows_best_sols1, windows_sol_times1 = sweep_all_window_vehicle_selection(
+        vehicle_ids_list, detection_matrices, in_junction_matrices, window_indices[:1], test_communication_num)
     sol_save_path = f"data/pkl/analysis/windows_best_sol_1b1.pkl"
     times_save_path = f"data/pkl/analysis/windows_sol_times_1b1.pkl"
     write_pickle(windows_best_sols1, sol_save_path)
     write_pickle(windows_sol_times1, times_save_path)
 
     # scenario 2
-    windows_best_sols2, windows_sol_times2 = [], []
-    for max_communication_num in tqdm(test_communication_num, desc="Scenario 2"):
-        all_window_best_sol, solution_time = optimize_all_window_vehicle_selection(
-            vehicle_ids_list, detection_matrices, in_junction_matrices, window_indices[1:], max_communication_num)
-        windows_best_sols2.append(all_window_best_sol)
-        windows_sol_times2.append(solution_time)
+    windows_best_sols2, windows_sol_times2 = sweep_all_window_vehicle_selection(
+        vehicle_ids_list, detection_matrices, in_junction_matrices, window_indices[1:], test_communication_num)
     sol_save_path = f"data/pkl/analysis/windows_best_sol_1b2.pkl"
     times_save_path = f"data/pkl/analysis/windows_sol_times_1b2.pkl"
     write_pickle(windows_best_sols2, sol_save_path)
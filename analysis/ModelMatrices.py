@@ -0,0 +1,121 @@
+import numpy as np
+from scipy.sparse import csr_matrix
+from preprocess.DetectionMatrix import DetectionMatrix
+
+
+# 靠近停止线的栅格 (编号 _0 ~ _4)
+BOUNDARY_GRID_SUFFIXES = ('_0', '_1', '_2', '_3', '_4')
+
+
+def as_detection_matrix(detection_matrix):
+    # 兼容旧版稠密 (栅格, 车辆, 时间) 数组
+    if isinstance(detection_matrix, DetectionMatrix):
+        return detection_matrix
+    return DetectionMatrix.from_dense(detection_matrix)
+
+def grid_weights(grids_keys, num_grids, boundary_weight, other_weight=1):
+    return np.array([boundary_weight if key.endswith(BOUNDARY_GRID_SUFFIXES) else other_weight
+                     for key in grids_keys[:num_grids]], dtype=float)
+
+def nonzero_grids(detection_matrix):
+    # 每个非零元所属的栅格下标
+    return np.repeat(np.arange(detection_matrix.shape[0]), np.diff(detection_matrix.indptr))
+
+def coverage_matrix(detection_matrix, per_period=False):
+    # 覆盖约束系数 (行 × 车辆) 的稀疏矩阵
+    # per_period=False: 行为栅格 m, 系数为车辆探测到该栅格的时刻数; True: 行为 (m, j), 行号 m * num_periods + j
+    num_grids, num_vehicles, num_periods = detection_matrix.shape
+    grids = nonzero_grids(detection_matrix)
+    if per_period:
+        rows, num_rows = grids * num_periods + detection_matrix.time, num_grids * num_periods
+    else:
+        rows, num_rows = grids, num_grids
+    # 重复的 (行, 车辆) 在构造时累加
+    return csr_matrix((np.ones(detection_matrix.nnz), (rows, detection_matrix.vehicle)), shape=(num_rows, num_vehicles))
+
+def overlap_coefficients(detection_matrix, weights=None):
+    # 重复探测惩罚中 x[i] 的系数: 车辆 i 的探测次数 (可按栅格加权)
+    vehicle = np.asarray(detection_matrix.vehicle, dtype=np.int64)
+    nonzero_weights = None if weights is None else weights[nonzero_grids(detection_matrix)]
+    return np.bincount(vehicle, weights=nonzero_weights, minlength=detection_matrix.shape[1]).astype(float)
+
+class SelectionInstance:
+    # 选车模型的系数: 覆盖矩阵 (行 × 车辆) 及行权重, 重复探测系数, 在交叉口矩阵 (车辆 × 时间), 上一窗口选中的车辆
+    # vehicles 为各列对应的原始车辆下标, 预处理删除列后由 expand 映射回原始解
+    def __init__(self, coverage, row_weights, overlap, in_junction_matrix, previous_vehicle_indices, big_m,
+                 vehicles=None, num_vehicles=None):
+        self.coverage = csr_matrix(coverage)
+        self.row_weights = np.asarray(row_weights, dtype=float)
+        self.overlap = np.asarray(overlap, dtype=float)
+        self.in_junction = np.asarray(in_junction_matrix, dtype=float)
+        self.previous = sorted(set(int(i) for i in previous_vehicle_indices))
+        self.big_m = big_m
+        self.vehicles = np.arange(self.coverage.shape[1]) if vehicles is None else np.asarray(vehicles)
+        self.num_vehicles = self.coverage.shape[1] if num_vehicles is None else num_vehicles
+
+    @property
+    def shape(self):
+        return self.coverage.shape
+
+    def expand(self, values):
+        # 约简后的解 -> 原始车辆顺序的解, 被删除的车辆取 0
+        full = np.zeros(self.num_vehicles)
+        full[self.vehicles] = values
+        return full.tolist()
+
+    def start_from(self, vehicle_indices):
+        # 原始车辆下标 -> 约简后车辆的 0/1 初始解, 被删除的车辆不参与
+        start = np.zeros(self.num_vehicles)
+        start[list(vehicle_indices)] = 1
+        return start[self.vehicles]
+
+    def is_feasible(self, values, max_communication_num):
+        # 约简后的 0/1 解是否满足带宽约束, 且存在满足覆盖约束的 r (r = 覆盖行)
+        detections = self.coverage @ values
+        return bool(np.all(self.in_junction.T @ values <= max_communication_num) and np.all(detections <= self.big_m))
+
+    def dominated_vehicles(self):
+        # vehicle i 支配 j: j 覆盖的行 i 都覆盖, 重复探测系数与各时刻带宽占用不大于 j, 且 j 连续选中时 i 也连续选中;
+        # 在可能起作用的 big-M 行 (系数和 > big_m) 上系数逐行不大于 j. 用 i 替换 j 不会使任何目标变差
+        num_vehicles = self.coverage.shape[1]
+        support = (self.coverage > 0).astype(np.int32)
+        support_size = np.asarray(support.sum(axis=0)).ravel()
+        dominates = (support.T @ support).toarray() == support_size[None, :]
+        dominates &= self.overlap[:, None] <= self.overlap[None, :]
+        for column in self.in_junction.T:
+            dominates &= column[:, None] <= column[None, :]
+        previous = np.zeros(num_vehicles, dtype=bool)
+        previous[self.previous] = True
+        dominates &= previous[:, None] | ~previous[None, :]
+        binding = np.flatnonzero(np.asarray(self.coverage.sum(axis=1)).ravel() > self.big_m)
+        for row in self.coverage[binding].toarray():
+            dominates &= row[:, None] <= row[None, :]
+        np.fill_diagonal(dominates, False)
+
+        # 互相支配 (完全等价) 的车辆只保留下标最小的一个
+        mutual = dominates & dominates.T
+        return (dominates & ~mutual).any(axis=0) | np.triu(mutual, k=1).any(axis=0)
+
+    def reduce(self):
+        # 删除被支配的车辆列, 删除无车辆可探测的行 (r 固定为 0), 合并系数完全相同的行 (权重相加)
+        keep_vehicles = np.flatnonzero(~self.dominated_vehicles())
+        coverage = self.coverage[:, keep_vehicles].tocsr()
+        coverage.sort_indices()
+
+        # 行按 (列下标, 系数) 分组, 空行不进入任何组
+        groups, representatives = {}, []
+        row_group = np.full(coverage.shape[0], -1)
+        for m in np.flatnonzero(np.diff(coverage.indptr)):
+            start, end = coverage.indptr[m], coverage.indptr[m + 1]
+            key = (coverage.indices[start:end].tobytes(), coverage.data[start:end].tobytes())
+            if key not in groups:
+                groups[key] = len(groups)
+                representatives.append(m)
+            row_group[m] = groups[key]
+        grouped = row_group >= 0
+        row_weights = np.bincount(row_group[grouped], weights=self.row_weights[grouped], minlength=len(groups))
+
+        previous = set(self.previous)
+        return SelectionInstance(coverage[representatives], row_weights, self.overlap[keep_vehicles],
+                                 self.in_junction[keep_vehicles], [k for k, i in enumerate(keep_vehicles) if i in previous],
+                                 self.big_m, self.vehicles[keep_vehicles], self.num_vehicles)
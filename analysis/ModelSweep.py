@@ -0,0 +1,106 @@
+import time
+
+
+class CommunicationSweep:
+    # 同一窗口内 max_communication_num 的参数扫描: 模型只构建一次
+    # 通信成本与稳定性目标写成 K * z2 - x.sum() == K 的形式, 改变 K 时只需修改 z2/z4 的系数和右端项
+    def __init__(self, model, instance, x, bandwidth, communication, z2, stability=None, z4=None):
+        self.model = model
+        self.instance = instance
+        self.x = x
+        self.bandwidth = bandwidth
+        self.communication = communication
+        self.z2 = z2
+        self.stability = stability
+        self.z4 = z4
+
+    def set_communication_num(self, max_communication_num):
+        self.bandwidth.RHS = max_communication_num
+        self.model.chgCoeff(self.communication, self.z2, max_communication_num)
+        self.communication.RHS = max_communication_num
+        if self.stability is not None:
+            self.model.chgCoeff(self.stability, self.z4, max_communication_num)
+            self.stability.RHS = max_communication_num
+
+    def start_from(self, vehicle_indices):
+        return self.instance.start_from(vehicle_indices)
+
+    def solve(self, max_communication_num, start=None, time_limit=None):
+        # start: 约简后车辆的初始解 (MIP start), 返回 (原始车辆顺序的解, 约简后的解)
+        # time_limit: 求解时间上限 (s), 到时返回当前最好的可行解
+        self.set_communication_num(max_communication_num)
+        if start is not None:
+            self.x.Start = start
+        if time_limit is not None:
+            self.model.Params.TimeLimit = max(time_limit, 0)
+        self.model.optimize()
+        if self.model.SolCount == 0:
+            return [0.0] * self.instance.num_vehicles, None
+        return self.instance.expand(self.x.X), self.x.X
+
+    def run(self, communication_nums):
+        # 依次求解, 每次以上一次的解作为 MIP start; K 递增时上一解仍可行
+        solutions, solution_times = [], []
+        start = None
+        for max_communication_num in communication_nums:
+            start_time = time.time()
+            solution, reduced_solution = self.solve(max_communication_num, start)
+            solution_times.append(time.time() - start_time)
+            solutions.append(solution)
+            if reduced_solution is not None:
+                start = reduced_solution
+        return solutions, solution_times
+
+def sweep_all_windows(build_model, previous_vehicle_selection, vehicle_ids_list, detection_matrices, in_junction_matrices,
+                      window_indices, communication_nums):
+    # 结果与对每个 max_communication_num 分别调用 optimize_all_window_vehicle_selection 相同:
+    # 返回 (各 K 的逐窗口选车结果, 各 K 的逐窗口求解时间); 同一窗口中上一窗口选车结果相同的 K 共用一个模型
+    all_window_best_sols = [[] for _ in communication_nums]
+    solution_times = [[] for _ in communication_nums]
+    previous_selected_vehicle_ids = [[] for _ in communication_nums]
+    for i in window_indices:
+        vehicle_ids = vehicle_ids_list[i]
+        detection_matrix = detection_matrices[i]
+        in_junction_matrix = in_junction_matrices[i]
+        groups = {}
+        for k in range(len(communication_nums)):
+            previous_vehicle_indices = tuple(previous_vehicle_selection(vehicle_ids, previous_selected_vehicle_ids[k]))
+            groups.setdefault(previous_vehicle_indices, []).append(k)
+
+        for previous_vehicle_indices, group in groups.items():
+            start_time = time.time()
+            sweep = build_model(detection_matrix, in_junction_matrix, list(previous_vehicle_indices), communication_nums[group[0]])
+            build_time = time.time() - start_time
+            window_sols, window_times = sweep.run([communication_nums[k] for k in group])
+            # 建模时间计入该组第一次求解
+            window_times[0] += build_time
+            for k, window_sol, window_time in zip(group, window_sols, window_times):
+                selected_vehicle_ids = [vehicle_ids[j] for j, x in enumerate(window_sol) if x > 0.5]
+                all_window_best_sols[k].append(selected_vehicle_ids)
+                solution_times[k].append(window_time)
+                previous_selected_vehicle_ids[k] = selected_vehicle_ids
+    return all_window_best_sols, solution_times
+
+def rolling_horizon(build_model, vehicle_ids_list, detection_matrices, in_junction_matrices, window_indices,
+                    max_communication_num, time_limit=None, warm_start=True):
+    # 滚动时域: 逐窗口求解, 上一窗口的选车结果按车辆 ID 映射为本窗口的稳定性约束与 MIP start
+    # time_limit: 每个窗口的期限 (s, 含建模时间), 到时使用当前最好的可行解; 没有可行解时不选车 (全 0 解总是可行)
+    all_window_best_sol = []
+    solution_time = []
+    previous_selected_vehicle_ids = []
+    for i in window_indices:
+        start_time = time.time()
+        vehicle_ids = vehicle_ids_list[i]
+        vehicle_index = {vehicle_id: j for j, vehicle_id in enumerate(vehicle_ids)}
+        previous_vehicle_indices = sorted(vehicle_index[vehicle_id] for vehicle_id in previous_selected_vehicle_ids if vehicle_id in vehicle_index)
+
+        sweep = build_model(detection_matrices[i], in_junction_matrices[i], previous_vehicle_indices, max_communication_num)
+        start = sweep.start_from(previous_vehicle_indices) if warm_start and previous_vehicle_indices else None
+        remaining = None if time_limit is None else time_limit - (time.time() - start_time)
+        window_sol, _ = sweep.solve(max_communication_num, start, remaining)
+
+        selected_vehicle_ids = [vehicle_ids[j] for j, x in enumerate(window_sol) if x > 0.5]
+        all_window_best_sol.append(selected_vehicle_ids)
+        solution_time.append(time.time() - start_time)
+        previous_selected_vehicle_ids = selected_vehicle_ids
+    return all_window_best_sol, solution_time
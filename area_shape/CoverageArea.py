@@ -0,0 +1,48 @@
+import numpy as np
+
+
+def polygon_bounds(points):
+    xs = [point[0] for point in points]
+    ys = [point[1] for point in points]
+    return min(xs), min(ys), max(xs), max(ys)
+
+def is_axis_aligned_rectangle(points):
+    points = list(points)
+    if len(points) > 4 and tuple(points[0]) == tuple(points[-1]):
+        points = points[:-1]
+    if len(points) != 4:
+        return False
+    for (x0, y0), (x1, y1) in zip(points, points[1:] + points[:1]):
+        if x0 != x1 and y0 != y1:
+            return False
+    left, bottom, right, top = polygon_bounds(points)
+    return left < right and bottom < top
+
+def _quadrant_area(x, y, radius):
+    # 圆心在原点的圆与 [0, x] × [0, y] 的交集面积 (x, y >= 0)
+    x = np.minimum(x, radius)
+    y = np.minimum(y, radius)
+    x_cross = np.sqrt(np.maximum(radius**2 - y**2, 0))
+    x_flat = np.minimum(x, x_cross)
+
+    def arc_integral(u):
+        # ∫_0^u sqrt(r^2 - s^2) ds
+        ratio = np.clip(u / np.where(radius > 0, radius, 1), -1, 1)
+        return 0.5 * (u * np.sqrt(np.maximum(radius**2 - u**2, 0)) + radius**2 * np.arcsin(ratio))
+
+    return y * x_flat + arc_integral(x) - arc_integral(x_flat)
+
+def _signed_quadrant_area(x, y, radius):
+    return np.sign(x) * np.sign(y) * _quadrant_area(np.abs(x), np.abs(y), radius)
+
+def circle_rect_overlap_area(cx, cy, radius, left, bottom, right, top):
+    # 圆与轴对齐矩形交集的精确面积, 所有参数支持 numpy 广播
+    cx, cy, radius = np.asarray(cx, dtype=float), np.asarray(cy, dtype=float), np.asarray(radius, dtype=float)
+    x0, x1 = np.asarray(left, dtype=float) - cx, np.asarray(right, dtype=float) - cx
+    y0, y1 = np.asarray(bottom, dtype=float) - cy, np.asarray(top, dtype=float) - cy
+    return (_signed_quadrant_area(x1, y1, radius) - _signed_quadrant_area(x0, y1, radius)
+            - _signed_quadrant_area(x1, y0, radius) + _signed_quadrant_area(x0, y0, radius))
+
+def ring_rect_overlap_area(cx, cy, inner_radius, outer_radius, left, bottom, right, top):
+    return (circle_rect_overlap_area(cx, cy, outer_radius, left, bottom, right, top)
+            - circle_rect_overlap_area(cx, cy, inner_radius, left, bottom, right, top))
@@ -0,0 +1,46 @@
+import numpy as np
+from matplotlib.path import Path
+from area_shape.CoverageArea import polygon_bounds, is_axis_aligned_rectangle
+
+
+UNASSIGNED = -1
+
+
+class LaneIndex:
+    # 车道点分类索引: 轴对齐车道的 x/y 边界排序后构成压缩网格, 每个单元格要么完全属于某条车道, 要么不属于任何车道
+    def __init__(self, lane_dict):
+        self.lanes = list(lane_dict.keys())
+        rect_ids, rect_bounds = [], []
+        # 非矩形车道回退到 Path.contains_points
+        self.polygon_lanes = []
+        for k, polygon in enumerate(lane_dict.values()):
+            if is_axis_aligned_rectangle(polygon):
+                rect_ids.append(k)
+                rect_bounds.append(polygon_bounds(polygon))
+            else:
+                self.polygon_lanes.append((k, Path(polygon)))
+
+        rect_bounds = np.array(rect_bounds, dtype=float).reshape(-1, 4)
+        self.xs = np.unique(rect_bounds[:, [0, 2]])
+        self.ys = np.unique(rect_bounds[:, [1, 3]])
+        self.table = np.full((max(len(self.xs) - 1, 0), max(len(self.ys) - 1, 0)), UNASSIGNED, dtype=np.int32)
+        # 逆序写入, 字典中靠前的车道优先, 与逐车道判断后 break 的顺序一致
+        for k, (left, bottom, right, top) in reversed(list(zip(rect_ids, rect_bounds))):
+            i0, i1 = np.searchsorted(self.xs, [left, right])
+            j0, j1 = np.searchsorted(self.ys, [bottom, top])
+            self.table[i0:i1, j0:j1] = k
+
+    def classify(self, points):
+        # (N, 2) 点 -> 车道序号 (self.lanes 下标), 不在任何车道内为 UNASSIGNED
+        points = np.asarray(points, dtype=float)[:, :2]
+        labels = np.full(len(points), UNASSIGNED, dtype=np.int32)
+        if self.table.size:
+            ix = np.searchsorted(self.xs, points[:, 0], side='right') - 1
+            iy = np.searchsorted(self.ys, points[:, 1], side='right') - 1
+            inside = (ix >= 0) & (ix < self.table.shape[0]) & (iy >= 0) & (iy < self.table.shape[1])
+            labels[inside] = self.table[ix[inside], iy[inside]]
+
+        for k, path in self.polygon_lanes:
+            candidates = np.flatnonzero((labels == UNASSIGNED) | (labels > k))
+            labels[candidates[path.contains_points(points[candidates])]] = k
+        return labels
@@ -1,17 +1,28 @@
 import os
 import pickle
+import tempfile
 import pandas as pd
 import numpy as np
 from matplotlib.path import Path
+from shapely.geometry import Point, Polygon
 import matplotlib.pyplot as plt
-from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import shared_memory
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
 
 from LiDAR.Lidar import LiDARTypes
 from LiDAR.LidarPosition import LIDARPosition
 from LiDAR.LidarPointCloudModel import simulate_lidar_points
+from LiDAR.LidarFootprint import lidar_ground_footprint
+from utils import TrajectoryIndex, lookup_vehicle
+from create_data.projection_store import ProjectionChunkWriter, ProjectionReader, lane_point_totals
+from area_shape.LaneIndex import LaneIndex
+from area_shape.CoverageArea import polygon_bounds, is_axis_aligned_rectangle, ring_rect_overlap_area
 
 # 定义分块大小
 CHUNK_SIZE = 2000
+# 每个 worker 允许的未完成任务数
+IN_FLIGHT_PER_WORKER = 4
 _INPUT_PATH = r"C:\Users\hx01\WPSDrive\267329050\WPS云盘\研究生\0.毕业论文\code\lidar\data\202403201305"
 
 def write_pickle(obj, path):
@@ -32,9 +43,9 @@ def split_by_time(data, time_start, span):
     return data.sort_values(by=['t','veh_id'])
 
 def vehicle_position(data, t, veh_id):
-    row = data[(data['t'] == t) & (data['veh_id'] == veh_id)]
-    if not row.empty:
-        return row.iloc[0]['veh_x'], row.iloc[0]['veh_y']
+    row = lookup_vehicle(data, t, veh_id, ['veh_x', 'veh_y'])
+    if row is not None:
+        return row['veh_x'], row['veh_y']
     else:
         print(f"Vehicle {veh_id} not found at time {t}.")
         return None
@@ -49,79 +60,200 @@ def calculate_polygon_area(polygon):
     return 0.5 * np.abs(np.dot(x, np.roll(y, 1)) - np.dot(y, np.roll(x, 1)))
 
 def calculate_lane_coverage(point_cloud_array, lane_dict):
-    lane_coverage = {lane: set() for lane in lane_dict}
-    unique_points = set(tuple(point[:2]) for point in point_cloud_array)
-    
-    for point in unique_points:
-        for lane, polygon in lane_dict.items():
-            if is_point_in_polygon(point, polygon):
-                lane_coverage[lane].add(point)
-                break
+    lane_index = lane_dict if isinstance(lane_dict, LaneIndex) else LaneIndex(lane_dict)
+    lane_coverage = {lane: set() for lane in lane_index.lanes}
+    unique_points = np.unique(np.asarray(point_cloud_array)[:, :2], axis=0)
+    labels = lane_index.classify(unique_points)
+
+    for k in np.unique(labels[labels >= 0]):
+        lane_coverage[lane_index.lanes[k]] = set(map(tuple, unique_points[labels == k].tolist()))
 
     return lane_coverage
 
+def calculate_lane_coverage_area(footprint, lane_dict):
+    # 解析足迹 (传感器位置, 环带集合) 与车道的精确交集面积
+    (sensor_x, sensor_y), rings = footprint
+    lane_area = {}
+    for lane, polygon in lane_dict.items():
+        if is_axis_aligned_rectangle(polygon):
+            left, bottom, right, top = polygon_bounds(polygon)
+            area = sum(ring_rect_overlap_area(sensor_x, sensor_y, r_in, r_out, left, bottom, right, top) for r_in, r_out in rings)
+        else:
+            lane_polygon = Polygon(polygon).buffer(0)
+            area = sum(lane_polygon.intersection(Point(sensor_x, sensor_y).buffer(r_out, 256).difference(
+                Point(sensor_x, sensor_y).buffer(r_in, 256))).area for r_in, r_out in rings)
+        lane_area[lane] = float(area)
+    return lane_area
+
+def generate_particular_vehicle_coverage_area(data_mapping, t, veh_id, lidar, lidar_pos, lane_dict):
+    row = lookup_vehicle(data_mapping, t, veh_id, ['veh_x', 'veh_y', 'veh_len', 'veh_wid', 'veh_hig'])
+    if row is not None:
+        veh_x, veh_y, veh_len, veh_wid, veh_hig = row['veh_x'], row['veh_y'], row['veh_len'], row['veh_wid'], row['veh_hig']
+        footprint = lidar_ground_footprint(lidar, veh_x, veh_y, veh_len, veh_wid, veh_hig, lidar_pos)
+        return calculate_lane_coverage_area(footprint, lane_dict)
+    else:
+        print(f"Vehicle {veh_id} not found at time {t}.")
+        return {}
+
 def generate_particular_vehicle_point_clouds_projection(data_mapping, t, veh_id, lidar, lidar_pos, lane_dict):
-    row = data_mapping[(data_mapping['t'] == t) & (data_mapping['veh_id'] == veh_id)]
-    if not row.empty:
-        veh_x, veh_y, veh_len, veh_wid, veh_hig = row.iloc[0]['veh_x'], row.iloc[0]['veh_y'], row.iloc[0]['veh_len'], row.iloc[0]['veh_wid'], row.iloc[0]['veh_hig']
+    row = lookup_vehicle(data_mapping, t, veh_id, ['veh_x', 'veh_y', 'veh_len', 'veh_wid', 'veh_hig'])
+    if row is not None:
+        veh_x, veh_y, veh_len, veh_wid, veh_hig = row['veh_x'], row['veh_y'], row['veh_len'], row['veh_wid'], row['veh_hig']
         pc_arary = simulate_lidar_points(lidar, veh_x, veh_y, veh_len, veh_wid, veh_hig, lidar_pos)
         return calculate_lane_coverage(pc_arary, lane_dict)
     else:
         print(f"Vehicle {veh_id} not found at time {t}.")
         return np.array([])
 
-def generate_projection_for_all_vehicles(data_mapping, lidar, lidar_pos, lane_dict):
-    time_veh_id_combinations = data_mapping[['t', 'veh_id']].drop_duplicates()
-    
-    projection_data = {}
-    with ThreadPoolExecutor(max_workers=8) as executor:
-        future_to_veh_id = {executor.submit(generate_particular_vehicle_point_clouds_projection, data_mapping, row['t'], row['veh_id'], lidar, lidar_pos, lane_dict):
-                            (row['t'], row['veh_id']) for _, row in time_veh_id_combinations.iterrows()}
-        
-        for future in future_to_veh_id:
-            t, veh_id = future_to_veh_id[future]
+# 进程池共享内存中的轨迹数值列
+_SHARED_COLUMNS = ['t', 'veh_x', 'veh_y', 'veh_len', 'veh_wid', 'veh_hig']
+_worker_state = {}
+
+def _share_trajectory(trajectory_index):
+    values = np.stack([np.asarray(trajectory_index.columns[name], dtype=np.float64) for name in _SHARED_COLUMNS])
+    shm = shared_memory.SharedMemory(create=True, size=max(values.nbytes, 1))
+    np.ndarray(values.shape, dtype=np.float64, buffer=shm.buf)[:] = values
+    return shm, values.shape
+
+def _init_projection_worker(shm_name, shape, veh_ids, lidar, lidar_pos, lane_index):
+    # 共享内存由主进程负责 unlink
+    shm = shared_memory.SharedMemory(name=shm_name)
+    values = np.ndarray(shape, dtype=np.float64, buffer=shm.buf)
+    _worker_state.update(shm=shm, columns=dict(zip(_SHARED_COLUMNS, values)), veh_ids=veh_ids,
+                         lidar=lidar, lidar_pos=lidar_pos, lane_index=lane_index)
+
+def _project_rows(rows):
+    columns, veh_ids = _worker_state['columns'], _worker_state['veh_ids']
+    results = []
+    for i in rows:
+        t, veh_id = columns['t'][i].item(), veh_ids[i]
+        try:
+            pc_array = simulate_lidar_points(_worker_state['lidar'], columns['veh_x'][i], columns['veh_y'][i], columns['veh_len'][i],
+                                             columns['veh_wid'][i], columns['veh_hig'][i], _worker_state['lidar_pos'])
+            results.append(((t, veh_id), calculate_lane_coverage(pc_array, _worker_state['lane_index'])))
+        except Exception as e:
+            print(f"Error generating projection for vehicle {veh_id} at time {t}: {e}")
+    return results
+
+def bounded_submit(executor, fn, tasks, max_in_flight, ordered=True):
+    # 最多 max_in_flight 个未完成任务 (背压), 逐个返回 (task, future); ordered=False 时按完成顺序返回
+    tasks = iter(tasks)
+    pending = deque() if ordered else {}
+
+    def submit_next():
+        for task in tasks:
+            future = executor.submit(fn, *task)
+            if ordered:
+                pending.append((task, future))
+            else:
+                pending[future] = task
+            return
+
+    for _ in range(max_in_flight):
+        submit_next()
+    while pending:
+        if ordered:
+            task, future = pending.popleft()
+            future.exception()
+            submit_next()
+            yield task, future
+        else:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                task = pending.pop(future)
+                submit_next()
+                yield task, future
+
+def _time_batches(trajectory_index):
+    # 每个时间步的 (t, veh_id) 首行行号为一个批次
+    batch, batch_t = [], None
+    for t, veh_id in trajectory_index.keys():
+        if batch and t != batch_t:
+            yield (np.array(batch, dtype=np.int64),)
+            batch = []
+        batch.append(trajectory_index.row_index(t, veh_id))
+        batch_t = t
+    if batch:
+        yield (np.array(batch, dtype=np.int64),)
+
+def _iter_projections_process(trajectory_index, lidar, lidar_pos, lane_index, max_workers, max_in_flight, ordered):
+    shm, shape = _share_trajectory(trajectory_index)
+    try:
+        with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_projection_worker,
+                                 initargs=(shm.name, shape, trajectory_index.veh_id, lidar, lidar_pos, lane_index)) as executor:
+            for _, future in bounded_submit(executor, _project_rows, _time_batches(trajectory_index), max_in_flight, ordered):
+                yield from future.result()
+    finally:
+        shm.close()
+        shm.unlink()
+
+def _iter_projections_thread(trajectory_index, lidar, lidar_pos, lane_index, max_workers, max_in_flight, ordered):
+    tasks = ((trajectory_index, t, veh_id, lidar, lidar_pos, lane_index) for t, veh_id in trajectory_index.keys())
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for (_, t, veh_id, _, _, _), future in bounded_submit(executor, generate_particular_vehicle_point_clouds_projection, tasks, max_in_flight, ordered):
             try:
-                projection = future.result()
-                count = sum(1 for value in projection.values() if len(value))
-                if count > 0:
-                    projection_data[(t, veh_id)] = projection
+                yield (t, veh_id), future.result()
             except Exception as e:
                 print(f"Error generating projection for vehicle {veh_id} at time {t}: {e}")
-    
+
+def iter_projections(data_mapping, lidar, lidar_pos, lane_dict, backend='thread', max_workers=None, max_in_flight=None, ordered=True):
+    # backend: 'thread' 线程池逐车辆提交; 'process' 进程池按时间步批量提交, 轨迹列放入共享内存
+    # 未完成任务数不超过 max_in_flight, 结果边生成边消费, 内存占用与轨迹长度无关
+    trajectory_index = data_mapping if isinstance(data_mapping, TrajectoryIndex) else TrajectoryIndex(data_mapping)
+    lane_index = lane_dict if isinstance(lane_dict, LaneIndex) else LaneIndex(lane_dict)
+    max_workers = max_workers or os.cpu_count()
+    max_in_flight = max_in_flight or IN_FLIGHT_PER_WORKER * max_workers
+    if backend == 'thread':
+        return _iter_projections_thread(trajectory_index, lidar, lidar_pos, lane_index, max_workers, max_in_flight, ordered)
+    elif backend == 'process':
+        return _iter_projections_process(trajectory_index, lidar, lidar_pos, lane_index, max_workers, max_in_flight, ordered)
+    raise ValueError(f"Invalid backend:{backend}")
+
+def generate_projection_for_all_vehicles(data_mapping, lidar, lidar_pos, lane_dict, backend='thread', max_workers=8, max_in_flight=None, ordered=True):
+    projection_data = {}
+    for (t, veh_id), projection in iter_projections(data_mapping, lidar, lidar_pos, lane_dict, backend, max_workers, max_in_flight, ordered):
+        try:
+            count = sum(1 for value in projection.values() if len(value))
+            if count > 0:
+                projection_data[(t, veh_id)] = projection
+        except Exception as e:
+            print(f"Error generating projection for vehicle {veh_id} at time {t}: {e}")
+
     return projection_data
 
-def generate_and_save_projection_for_all_vehicles(data_mapping, lidar, lidar_pos, lane_dict, output_directory):
-    time_veh_id_combinations = data_mapping[['t', 'veh_id']].drop_duplicates()
+def generate_and_save_projection_for_all_vehicles(data_mapping, lidar, lidar_pos, lane_dict, output_directory, backend='thread', max_workers=10,
+                                                  max_in_flight=None, ordered=True, chunk_size=CHUNK_SIZE, output_format='pkl', lane_mapping=None):
+    # output_format: 'pkl' 为原始字典分块; 'npy' 为列式分块 (见 projection_store)
+    if output_format == 'pkl':
+        save_chunk = lambda chunk_data, chunk_number: save_projection_data_to_disk(chunk_data, chunk_number, output_directory)
+    elif output_format == 'npy':
+        save_chunk = ProjectionChunkWriter(output_directory, lane_mapping).write
+    else:
+        raise ValueError(f"Invalid output format:{output_format}")
 
     current_chunk_data = {}
     current_chunk_number = 0
     total_count = 0
-    
-    with ThreadPoolExecutor(max_workers=10) as executor:
-        future_to_veh_id = {executor.submit(generate_particular_vehicle_point_clouds_projection, data_mapping, row['t'], row['veh_id'], lidar, lidar_pos, lane_dict):
-                            (row['t'], row['veh_id']) for _, row in time_veh_id_combinations.iterrows()}
 
-        for future in future_to_veh_id:
-            t, veh_id = future_to_veh_id[future]
-            try:
-                projection = future.result()
-                count = sum(1 for value in projection.values() if len(value))
-                if count > 0:
-                    current_chunk_data[(t, veh_id)] = projection
-                    total_count += 1
-                    
-                    # 每达到一定数量的数据项，就保存到磁盘
-                    if total_count % CHUNK_SIZE == 0:
-                        save_projection_data_to_disk(current_chunk_data, current_chunk_number, output_directory)
-                        current_chunk_data = {}
-                        current_chunk_number += 1
-                        
-            except Exception as e:
-                print(f"Error generating projection for vehicle {veh_id} at time {t}: {e}")
+    for (t, veh_id), projection in iter_projections(data_mapping, lidar, lidar_pos, lane_dict, backend, max_workers, max_in_flight, ordered):
+        try:
+            count = sum(1 for value in projection.values() if len(value))
+            if count > 0:
+                current_chunk_data[(t, veh_id)] = projection
+                total_count += 1
+
+                # 每达到一定数量的数据项，就保存到磁盘
+                if total_count % chunk_size == 0:
+                    save_chunk(current_chunk_data, current_chunk_number)
+                    current_chunk_data = {}
+                    current_chunk_number += 1
+
+        except Exception as e:
+            print(f"Error generating projection for vehicle {veh_id} at time {t}: {e}")
 
-        # 处理剩余不足一个chunk的数据
-        if current_chunk_data:
-            save_projection_data_to_disk(current_chunk_data, current_chunk_number, output_directory)
+    # 处理剩余不足一个chunk的数据
+    if current_chunk_data:
+        save_chunk(current_chunk_data, current_chunk_number)
 
 def main():
     data = pd.read_csv(f'{_INPUT_PATH}/sumoTrace_veh_type.csv', index_col=None)
@@ -143,39 +275,30 @@ def main():
     lidar = LiDARTypes.Test
     lidar_pos = LIDARPosition.FRONT_CENTER
     lane_dict = read_pickle("data/pkl/lane_dict.pkl")
+    trajectory_index = TrajectoryIndex(data_mapping)
+    lane_index = LaneIndex(lane_dict)
 
     # ------------------test------------------
-    test_t = data_mapping.iloc[0, 0]
-    test_veh_id = data_mapping.iloc[0, 1]
-    lane_projection = generate_particular_vehicle_point_clouds_projection(data_mapping, test_t, test_veh_id, lidar, lidar_pos, lane_dict)
+    test_t, test_veh_id = trajectory_index.keys()[0]
+    lane_projection = generate_particular_vehicle_point_clouds_projection(trajectory_index, test_t, test_veh_id, lidar, lidar_pos, lane_index)
     non_empty_keys_count = sum(1 for value in lane_projection.values() if len(value))
     print("non_empty_keys_count",non_empty_keys_count)
+    # 同一块数据的列式 (npy) 逐车道点数应与 pkl 格式一致
+    test_chunk = {(test_t, test_veh_id): lane_projection}
+    with tempfile.TemporaryDirectory() as check_directory:
+        ProjectionChunkWriter(check_directory, lane_mapping).write(test_chunk, 0)
+        assert ProjectionReader(check_directory).points_per_lane() == lane_point_totals(test_chunk), "npy lane point totals differ from pkl"
 
     # ------------------generate projection data------------------
     print("Projection Data Generating...")
-    projection_data = generate_and_save_projection_for_all_vehicles(data_mapping, lidar, lidar_pos, lane_dict, _INPUT_PATH)
+    generate_and_save_projection_for_all_vehicles(trajectory_index, lidar, lidar_pos, lane_index, _INPUT_PATH, backend='process',
+                                                  output_format='npy', lane_mapping=lane_mapping)
 
     # ------------------check data quality------------------
-    lane_point_totals = {}
-    time_veh_id_combinations = data_mapping[['t', 'veh_id']].drop_duplicates()
-
-    for index, row in time_veh_id_combinations.iterrows():
-        t = row['t']
-        veh_id = row['veh_id']
-
-        data_key = (t, veh_id)
-        if data_key in projection_data:
-            lane_point_mapping = projection_data[data_key]
-
-            for lane, point in lane_point_mapping.items():
-                if lane in lane_point_totals:
-                    lane_point_totals[lane] += len(point)
-                else:
-                    lane_point_totals[lane] = len(point)
-
+    lane_totals = ProjectionReader(_INPUT_PATH).points_per_lane()
 
-    lane_labels = sorted(lane_point_totals.keys())
-    lane_values = [lane_point_totals[lane] for lane in lane_labels]
+    lane_labels = sorted(lane_totals.keys())
+    lane_values = [lane_totals[lane] for lane in lane_labels]
 
     plt.figure(figsize=(12, 6))
     plt.bar(lane_labels, lane_values, align='center')
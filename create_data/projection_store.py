@@ -0,0 +1,170 @@
+import os
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from utils import read_pickle, write_pickle
+
+
+MANIFEST_NAME = 'projection_manifest.pkl'
+# 坐标量化: 0.1 m
+COORD_SCALE = 10
+
+# 每个 (t, veh_id) 一行
+KEY_DTYPE = np.dtype([('t', np.float64), ('veh', np.int32)])
+# 每个量化格一行, key 为所属 (t, veh_id) 在本块 keys 中的行号, count 为落在该格的原始投影点数
+POINT_DTYPE = np.dtype([('key', np.int32), ('lane', np.int16), ('x', np.int32), ('y', np.int32), ('count', np.int32)])
+
+
+class ProjectionChunkWriter:
+    # 列式分块输出: projection_keys_{n}.npy / projection_points_{n}.npy + 清单 projection_manifest.pkl
+    def __init__(self, output_directory, lane_mapping=None, coord_scale=COORD_SCALE):
+        self.output_directory = output_directory
+        self.coord_scale = coord_scale
+        # 车道编码沿用 lane_mapping.pkl, 未出现的车道顺延编号
+        self.lane_codes = dict(lane_mapping or {})
+        self.veh_codes = {}
+        self.chunks = []
+
+    def _lane_code(self, lane):
+        if lane not in self.lane_codes:
+            self.lane_codes[lane] = max(self.lane_codes.values(), default=0) + 1
+        return self.lane_codes[lane]
+
+    def _veh_code(self, veh_id):
+        return self.veh_codes.setdefault(veh_id, len(self.veh_codes))
+
+    def write(self, projection_data, chunk_number):
+        keys = np.empty(len(projection_data), dtype=KEY_DTYPE)
+        point_blocks = []
+        for k, ((t, veh_id), lane_points) in enumerate(projection_data.items()):
+            keys[k] = (t, self._veh_code(veh_id))
+            for lane, points in lane_points.items():
+                if not len(points):
+                    continue
+                xy = np.round(np.asarray(list(points), dtype=np.float64) * self.coord_scale).astype(np.int32)
+                # 量化后重合的点合并为一行并计数, 点数与 pkl 格式的 len(set) 一致
+                xy, counts = np.unique(xy, axis=0, return_counts=True)
+                block = np.empty(len(xy), dtype=POINT_DTYPE)
+                block['key'], block['lane'] = k, self._lane_code(lane)
+                block['x'], block['y'], block['count'] = xy[:, 0], xy[:, 1], counts
+                point_blocks.append(block)
+        points = np.concatenate(point_blocks) if point_blocks else np.empty(0, dtype=POINT_DTYPE)
+
+        keys_file, points_file = f'projection_keys_{chunk_number}.npy', f'projection_points_{chunk_number}.npy'
+        np.save(os.path.join(self.output_directory, keys_file), keys)
+        np.save(os.path.join(self.output_directory, points_file), points)
+        self.chunks.append({
+            'chunk': chunk_number,
+            'keys_file': keys_file,
+            'points_file': points_file,
+            'num_keys': len(keys),
+            'num_points': int(points['count'].sum()),
+            'num_cells': len(points),
+            't_min': float(keys['t'].min()) if len(keys) else None,
+            't_max': float(keys['t'].max()) if len(keys) else None,
+            'lanes': np.unique(points['lane']).tolist(),
+        })
+        self.write_manifest()
+
+    def write_manifest(self):
+        write_pickle({
+            'coord_scale': self.coord_scale,
+            'lane_codes': self.lane_codes,
+            'veh_ids': list(self.veh_codes),
+            'chunks': self.chunks,
+        }, os.path.join(self.output_directory, MANIFEST_NAME))
+
+def lane_point_totals(projection_data):
+    # pkl 格式 {(t, veh_id): {lane: set(points)}} 的逐车道点数, 用于核对列式分块
+    totals = {}
+    for lane_points in projection_data.values():
+        for lane, points in lane_points.items():
+            if len(points):
+                totals[lane] = totals.get(lane, 0) + len(points)
+    return totals
+
+def read_projection_manifest(output_directory):
+    return read_pickle(os.path.join(output_directory, MANIFEST_NAME))
+
+def load_projection_chunk(output_directory, chunk_entry, mmap_mode='r'):
+    keys = np.load(os.path.join(output_directory, chunk_entry['keys_file']), mmap_mode=mmap_mode)
+    points = np.load(os.path.join(output_directory, chunk_entry['points_file']), mmap_mode=mmap_mode)
+    return keys, points
+
+class ProjectionReader:
+    # 按清单惰性读取列式分块, 聚合逐块 (并行) 计算后合并, 不整体载入
+    def __init__(self, output_directory):
+        self.output_directory = output_directory
+        self.manifest = read_projection_manifest(output_directory)
+        self.lane_names = {code: lane for lane, code in self.manifest['lane_codes'].items()}
+        self.veh_ids = self.manifest['veh_ids']
+
+    def lane_codes(self, lanes):
+        # 车道名 -> 编码, 未出现在任何块中的车道跳过 (没有匹配的块, 点数为 0)
+        if lanes is None:
+            return None
+        codes = (self.manifest['lane_codes'].get(lane) for lane in lanes)
+        return sorted({code for code in codes if code is not None})
+
+    def chunks(self, t_start=None, t_end=None, lanes=None):
+        # 依据清单中的时间范围与车道集合跳过无关块
+        lane_codes = self.lane_codes(lanes)
+        for entry in self.manifest['chunks']:
+            if not entry['num_keys']:
+                continue
+            if t_start is not None and entry['t_max'] < t_start:
+                continue
+            if t_end is not None and entry['t_min'] > t_end:
+                continue
+            if lane_codes is not None and set(lane_codes).isdisjoint(entry['lanes']):
+                continue
+            yield entry
+
+    def iter_chunks(self, t_start=None, t_end=None, lanes=None):
+        for entry in self.chunks(t_start, t_end, lanes):
+            yield (entry,) + load_projection_chunk(self.output_directory, entry)
+
+    def _chunk_counts(self, entry, by, t_start, t_end, lanes):
+        keys, points = load_projection_chunk(self.output_directory, entry)
+        point_t = keys['t'][points['key']]
+        mask = np.ones(len(points), dtype=bool)
+        if t_start is not None:
+            mask &= point_t >= t_start
+        if t_end is not None:
+            mask &= point_t <= t_end
+        if lanes is not None:
+            mask &= np.isin(points['lane'], self.lane_codes(lanes))
+
+        if by == 'lane':
+            values = points['lane'][mask]
+        elif by == 'time':
+            values = point_t[mask]
+        elif by == 'vehicle':
+            values = keys['veh'][points['key'][mask]]
+        else:
+            raise ValueError(f"Invalid aggregation:{by}")
+        values, inverse = np.unique(values, return_inverse=True)
+        return values, np.bincount(inverse.ravel(), weights=points['count'][mask], minlength=len(values)).astype(np.int64)
+
+    def count_points(self, by, t_start=None, t_end=None, lanes=None, max_workers=None):
+        totals = {}
+        entries = list(self.chunks(t_start, t_end, lanes))
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            partials = executor.map(lambda entry: self._chunk_counts(entry, by, t_start, t_end, lanes), entries)
+            for values, counts in partials:
+                for value, count in zip(values.tolist(), counts.tolist()):
+                    totals[value] = totals.get(value, 0) + count
+
+        if by == 'lane':
+            return {self.lane_names[code]: count for code, count in totals.items()}
+        elif by == 'vehicle':
+            return {self.veh_ids[code]: count for code, count in totals.items()}
+        return totals
+
+    def points_per_lane(self, **kwargs):
+        return self.count_points('lane', **kwargs)
+
+    def points_per_time(self, **kwargs):
+        return self.count_points('time', **kwargs)
+
+    def points_per_vehicle(self, **kwargs):
+        return self.count_points('vehicle', **kwargs)
@@ -1,9 +1,20 @@
-import pandas as pd
-from shapely.geometry import Point, Polygon
+import os
+import argparse
 import concurrent.futures
-from tqdm import tqdm
-from utils import read_pickle, write_pickle
+from collections import OrderedDict
+from functools import lru_cache
+import numpy as np
+from utils import read_pickle, write_pickle, concat_ranges
+from area_shape.CoverageArea import circle_rect_overlap_area
 
+GRIDS_PATH = 'data/pkl/grids_dict.pkl'
+# 栅格空间索引的分桶边长 (m)
+BUCKET_SIZE = 10.0
+# 批处理每块的目标行数 (按时间步边界切分)
+BATCH_ROWS = 4096
+# 覆盖缓存的圆心量化分辨率 (m) 与容量
+CACHE_RESOLUTION = 0.5
+CACHE_SIZE = 65536
 
 def split_by_time(data, time_start, span):
     data = data[(data['t'] >= time_start) & (data['t'] < time_start + span)]
@@ -18,6 +29,7 @@ def get_direction(lane):
     raise ValueError(f"Invalid lane:{lane}")
 
 def create_grid_polygon(grid_points):
+    from shapely.geometry import Polygon
     return Polygon(grid_points)
 
 def preprocess_grids_dict(grids_dict):
@@ -41,61 +53,323 @@ def preprocess_grids_dict(grids_dict):
 
     return preprocessed_grids
 
+class GridArrays:
+    # 栅格边界的列数组, 供向量化覆盖计算
+    def __init__(self, preprocessed_grids):
+        self.ids = list(preprocessed_grids.keys())
+        self.left = np.array([grid["left"] for grid in preprocessed_grids.values()], dtype=float)
+        self.bottom = np.array([grid["bottom"] for grid in preprocessed_grids.values()], dtype=float)
+        self.right = np.array([grid["right"] for grid in preprocessed_grids.values()], dtype=float)
+        self.top = np.array([grid["top"] for grid in preprocessed_grids.values()], dtype=float)
+        self.area = (self.right - self.left) * (self.top - self.bottom)
+
+    def __len__(self):
+        return len(self.ids)
+
+def coverage_fractions(circle_center, circle_radius, grid_arrays, grid_indices=slice(None)):
+    # 圆覆盖各栅格面积的比例 (圆与轴对齐矩形交集的解析解)
+    cx, cy = circle_center
+    detected_area = circle_rect_overlap_area(cx, cy, circle_radius, grid_arrays.left[grid_indices], grid_arrays.bottom[grid_indices],
+                                             grid_arrays.right[grid_indices], grid_arrays.top[grid_indices])
+    return detected_area / grid_arrays.area[grid_indices]
+
 def intersects_circle(circle_center, circle_radius, left, right, bottom, top):
     cx, cy = circle_center
     cr = circle_radius
 
-    # 检查圆心是否在矩形内或圆与矩形边界相交
-    return (left - cr <= cx <= right + cr) and (bottom - cr <= cy <= top + cr) or (
-        (cx - left <= cr) or (cx - right >= -cr) or 
-        (cy - bottom <= cr) or (cy - top >= -cr)
-    )
+    # 圆心到矩形的最近距离不超过半径
+    dx = np.maximum(np.maximum(left - cx, cx - right), 0)
+    dy = np.maximum(np.maximum(bottom - cy, cy - top), 0)
+    return dx**2 + dy**2 <= cr**2
+
+class GridBucketIndex:
+    # 均匀分桶索引: 每个桶记录与之相交的栅格 (CSR), 圆查询只访问其外接正方形覆盖的桶
+    def __init__(self, grid_arrays, bucket_size=BUCKET_SIZE):
+        self.grid_arrays = grid_arrays
+        self.bucket_size = bucket_size
+        self.x0, self.y0 = grid_arrays.left.min(), grid_arrays.bottom.min()
+        self.nx = max(int(np.ceil((grid_arrays.right.max() - self.x0) / bucket_size)), 1)
+        self.ny = max(int(np.ceil((grid_arrays.top.max() - self.y0) / bucket_size)), 1)
+
+        i0, i1 = self._bucket_x(grid_arrays.left), self._bucket_x(grid_arrays.right)
+        j0, j1 = self._bucket_y(grid_arrays.bottom), self._bucket_y(grid_arrays.top)
+        width = i1 - i0 + 1
+        counts = width * (j1 - j0 + 1)
+        offsets = concat_ranges(np.zeros_like(counts), counts)
+        buckets = (np.repeat(i0, counts) + offsets % np.repeat(width, counts)) * self.ny + np.repeat(j0, counts) + offsets // np.repeat(width, counts)
+        order = np.argsort(buckets, kind='stable')
+        self.grid_ids = np.repeat(np.arange(len(grid_arrays)), counts)[order]
+        self.indptr = np.concatenate([[0], np.cumsum(np.bincount(buckets, minlength=self.nx * self.ny))])
+
+    def _bucket_x(self, x):
+        return np.clip(np.floor((np.asarray(x) - self.x0) / self.bucket_size).astype(np.int64), 0, self.nx - 1)
+
+    def _bucket_y(self, y):
+        return np.clip(np.floor((np.asarray(y) - self.y0) / self.bucket_size).astype(np.int64), 0, self.ny - 1)
+
+    def query(self, circle_center, circle_radius):
+        # 返回与圆相交的栅格下标
+        cx, cy = circle_center
+        bx = np.arange(self._bucket_x(cx - circle_radius), self._bucket_x(cx + circle_radius) + 1)
+        by = np.arange(self._bucket_y(cy - circle_radius), self._bucket_y(cy + circle_radius) + 1)
+        buckets = (bx[:, None] * self.ny + by[None, :]).ravel()
+        candidates = np.unique(self.grid_ids[concat_ranges(self.indptr[buckets], self.indptr[buckets + 1] - self.indptr[buckets])])
+        ga = self.grid_arrays
+        keep = intersects_circle(circle_center, circle_radius, ga.left[candidates], ga.right[candidates], ga.bottom[candidates], ga.top[candidates])
+        return candidates[keep]
+
+    def bucket_of(self, xs, ys):
+        return self._bucket_x(xs) * self.ny + self._bucket_y(ys)
+
+    def neighbourhood(self, circle_radius):
+        # 每个桶内任一圆心在半径内可能触及的栅格 (CSR); 索引范围外的圆心投影到边界桶, 候选集仍为超集
+        ga = self.grid_arrays
+        indices, counts = [], []
+        for bx in range(self.nx):
+            for by in range(self.ny):
+                left, bottom = self.x0 + bx * self.bucket_size, self.y0 + by * self.bucket_size
+                right, top = left + self.bucket_size, bottom + self.bucket_size
+                if bx == 0:
+                    left = -np.inf
+                if bx == self.nx - 1:
+                    right = np.inf
+                if by == 0:
+                    bottom = -np.inf
+                if by == self.ny - 1:
+                    top = np.inf
+                dx = np.maximum(np.maximum(ga.left - right, left - ga.right), 0)
+                dy = np.maximum(np.maximum(ga.bottom - top, bottom - ga.top), 0)
+                near = np.flatnonzero(dx**2 + dy**2 <= circle_radius**2)
+                indices.append(near)
+                counts.append(len(near))
+        return np.concatenate([[0], np.cumsum(counts)]), np.concatenate(indices)
+
+def covered_grids_batch_multi(xs, ys, radii, thresholds, grid_arrays, grid_index, neighbourhood):
+    # 多半径/多阈值一次计算: 候选 (圆心, 栅格) 对取自最大半径的邻域, 各半径复用同一批候选
+    # 返回 {(radius, threshold): (indptr, indices)}
+    xs, ys = np.asarray(xs, dtype=float), np.asarray(ys, dtype=float)
+    nb_indptr, nb_grids = neighbourhood
+    buckets = grid_index.bucket_of(xs, ys)
+    counts = nb_indptr[buckets + 1] - nb_indptr[buckets]
+    row_ids = np.repeat(np.arange(len(xs)), counts)
+    grids = nb_grids[concat_ranges(nb_indptr[buckets], counts)]
+    pair_x, pair_y = xs[row_ids], ys[row_ids]
+    left, bottom, right, top = grid_arrays.left[grids], grid_arrays.bottom[grids], grid_arrays.right[grids], grid_arrays.top[grids]
+
+    # 圆心到栅格的最近/最远距离: 完全在圆内的栅格覆盖比例为 1, 只有与圆周相交的栅格需要计算面积
+    dx = np.maximum(np.maximum(left - pair_x, pair_x - right), 0)
+    dy = np.maximum(np.maximum(bottom - pair_y, pair_y - top), 0)
+    nearest = dx**2 + dy**2
+    farthest = np.maximum(pair_x - left, right - pair_x)**2 + np.maximum(pair_y - bottom, top - pair_y)**2
+
+    results = {}
+    for radius in radii:
+        near = np.flatnonzero(nearest <= radius**2)
+        fractions = np.ones(len(near))
+        boundary = farthest[near] > radius**2
+        b = near[boundary]
+        fractions[boundary] = circle_rect_overlap_area(pair_x[b], pair_y[b], radius, left[b], bottom[b],
+                                                       right[b], top[b]) / grid_arrays.area[grids[b]]
+        for threshold in thresholds:
+            keep = near[fractions >= threshold]
+            indptr = np.concatenate([[0], np.cumsum(np.bincount(row_ids[keep], minlength=len(xs)))])
+            results[(radius, threshold)] = (indptr, grids[keep].astype(np.int32))
+    return results
+
+def covered_grids_batch(xs, ys, circle_radius, grid_arrays, grid_index, neighbourhood, threshold=0.5):
+    # 一批圆心的覆盖栅格, 返回 CSR (indptr, indices)
+    return covered_grids_batch_multi(xs, ys, [circle_radius], [threshold], grid_arrays, grid_index, neighbourhood)[(circle_radius, threshold)]
+
+class CoveredGrids:
+    # (t, veh_id) -> 覆盖栅格的 CSR 存储, 第 k 行的栅格下标为 indices[indptr[k]:indptr[k+1]]
+    def __init__(self, t, veh_id, indptr, indices, grid_ids):
+        self.t = t
+        self.veh_id = veh_id
+        self.indptr = indptr
+        self.indices = indices
+        self.grid_ids = grid_ids
 
-def find_covered_grids(circle_center, circle_radius, preprocessed_grids, threshold=0.5):
-    covered_grid_ids = []
-    grid_area = 4.6 * 3.2
+    def __len__(self):
+        return len(self.t)
 
-    for grid_id, grid_info in preprocessed_grids.items():
-        polygon = grid_info["polygon"]
-        left, bottom, right, top = grid_info["left"], grid_info["bottom"], grid_info["right"], grid_info["top"]
+    def grids_of(self, k):
+        return self.indices[self.indptr[k]:self.indptr[k + 1]]
 
-        # 快速过滤掉明显不与圆相交的网格
-        if not intersects_circle(circle_center, circle_radius, left, right, bottom, top):
-            continue
+    def to_dict(self):
+        return {(t, veh_id): [self.grid_ids[i] for i in self.grids_of(k)]
+                for k, (t, veh_id) in enumerate(zip(self.t.tolist(), self.veh_id.tolist()))}
 
-        detected_area = polygon.intersection(Point(circle_center).buffer(circle_radius)).area
-        if detected_area / grid_area >= threshold:
-            covered_grid_ids.append(grid_id)
+class CoverageCache:
+    # 以量化后的 (x, y, radius, threshold) 为键的 LRU 覆盖缓存; 圆心取量化点本身, 结果与写入顺序无关
+    def __init__(self, resolution=CACHE_RESOLUTION, maxsize=CACHE_SIZE):
+        self.resolution = resolution
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
 
-    return covered_grid_ids
+    def __len__(self):
+        return len(self.entries)
 
-grids_dict = read_pickle('data/pkl/grids_dict.pkl')
-preprocessed_grids_dict = preprocess_grids_dict(grids_dict)
-def calculate_covered_grids(row, circle_radius=50, preprocessed_grids_dict=preprocessed_grids_dict):
+    def quantize(self, circle_center):
+        cx, cy = circle_center
+        return int(round(cx / self.resolution)), int(round(cy / self.resolution))
+
+    def get_or_compute(self, circle_center, circle_radius, threshold, compute):
+        qx, qy = self.quantize(circle_center)
+        key = (qx, qy, circle_radius, threshold)
+        if key in self.entries:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return self.entries[key]
+        self.misses += 1
+        value = compute((qx * self.resolution, qy * self.resolution))
+        self.entries[key] = value
+        if len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+        return value
+
+    def info(self):
+        return {"hits": self.hits, "misses": self.misses, "size": len(self.entries),
+                "maxsize": self.maxsize, "resolution": self.resolution}
+
+    def clear(self):
+        self.entries.clear()
+        self.hits = self.misses = 0
+
+def find_covered_grids(circle_center, circle_radius, preprocessed_grids, threshold=0.5, grid_index=None, cache=None):
+    if cache is not None:
+        # 命中时返回缓存结果的副本, 调用方修改列表不影响缓存
+        return list(cache.get_or_compute(circle_center, circle_radius, threshold, lambda center: find_covered_grids(
+            center, circle_radius, preprocessed_grids, threshold, grid_index)))
+    grid_arrays = preprocessed_grids if isinstance(preprocessed_grids, GridArrays) else GridArrays(preprocessed_grids)
+    if grid_index is None:
+        candidates = np.arange(len(grid_arrays))
+    else:
+        # 快速过滤掉不与圆相交的网格
+        candidates = grid_index.query(circle_center, circle_radius)
+    covered = candidates[coverage_fractions(circle_center, circle_radius, grid_arrays, candidates) >= threshold]
+    return [grid_arrays.ids[i] for i in covered]
+
+@lru_cache(maxsize=4)
+def load_grids(grids_path=GRIDS_PATH):
+    # 首次使用时才读取栅格文件, 返回 (GridArrays, GridBucketIndex)
+    grid_arrays = GridArrays(preprocess_grids_dict(read_pickle(grids_path)))
+    return grid_arrays, GridBucketIndex(grid_arrays)
+
+def calculate_covered_grids(row, circle_radius=50, preprocessed_grids_dict=None, grid_index=None, cache=None):
+    if preprocessed_grids_dict is None:
+        preprocessed_grids_dict, grid_index = load_grids()
     t, veh_id, veh_x, veh_y, _ = row
     circle_center = (veh_x, veh_y)
-    covered_grids = find_covered_grids(circle_center, circle_radius, preprocessed_grids_dict)
+    covered_grids = find_covered_grids(circle_center, circle_radius, preprocessed_grids_dict, grid_index=grid_index, cache=cache)
     return (t, veh_id), covered_grids
 
-def parallel_calculate_covered_grids(df, max_workers=None):
-    result_dict = {}
+_worker_state = {}
+
+def _init_batch_worker(grid_arrays, grid_index, neighbourhood, radii, thresholds):
+    _worker_state.update(grid_arrays=grid_arrays, grid_index=grid_index, neighbourhood=neighbourhood,
+                         radii=radii, thresholds=thresholds)
+
+def _covered_grids_chunk(xs, ys):
+    state = _worker_state
+    return covered_grids_batch_multi(xs, ys, state['radii'], state['thresholds'], state['grid_arrays'],
+                                     state['grid_index'], state['neighbourhood'])
+
+def split_time_chunks(t, batch_rows=BATCH_ROWS):
+    # 按时间步边界把已排序的行切成约 batch_rows 行的连续块
+    boundaries = np.flatnonzero(np.diff(t)) + 1
+    cuts, last = [], 0
+    for boundary in boundaries:
+        if boundary - last >= batch_rows:
+            cuts.append(boundary)
+            last = boundary
+    return np.split(np.arange(len(t)), cuts) if len(t) else []
+
+def expand_csr(indptr, indices, rows):
+    # 按行号取 CSR 的若干行 (可重复), 返回新的 (indptr, indices)
+    counts = indptr[rows + 1] - indptr[rows]
+    return np.concatenate([[0], np.cumsum(counts)]), indices[concat_ranges(indptr[rows], counts)]
+
+def parallel_calculate_covered_grids_multi(df, radii, thresholds=(0.5,), max_workers=None, batch_rows=BATCH_ROWS,
+                                           preprocessed_grids_dict=None, grid_index=None, cache_resolution=None):
+    # 一次遍历轨迹得到所有 (radius, threshold) 组合的覆盖结果: {(radius, threshold): CoveredGrids}
+    from tqdm import tqdm
+    if preprocessed_grids_dict is None:
+        preprocessed_grids_dict, grid_index = load_grids()
+    elif grid_index is None:
+        grid_index = GridBucketIndex(preprocessed_grids_dict)
+    radii, thresholds = list(radii), list(thresholds)
+    df = df.sort_values(by=['t', 'veh_id'], kind='stable')
+    t, veh_id = df['t'].to_numpy(), df['veh_id'].to_numpy()
+    xs, ys = df['veh_x'].to_numpy(dtype=float), df['veh_y'].to_numpy(dtype=float)
+    neighbourhood = grid_index.neighbourhood(max(radii))
+    positions = None
+    if cache_resolution:
+        # 圆心按 cache_resolution 量化后去重, 相同位置只计算一次
+        quantized = np.stack([np.round(xs / cache_resolution), np.round(ys / cache_resolution)], axis=1)
+        positions, inverse = np.unique(quantized, axis=0, return_inverse=True)
+        xs, ys = positions[:, 0] * cache_resolution, positions[:, 1] * cache_resolution
+        chunks = np.array_split(np.arange(len(positions)), max(-(-len(positions) // batch_rows), 1))
+    else:
+        chunks = split_time_chunks(t, batch_rows)
+
+    combos = [(radius, threshold) for radius in radii for threshold in thresholds]
+    indptr_parts = {combo: [np.zeros(1, dtype=np.int64)] for combo in combos}
+    indices_parts = {combo: [] for combo in combos}
+    offsets = dict.fromkeys(combos, 0)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers or os.cpu_count(), initializer=_init_batch_worker,
+                                                initargs=(preprocessed_grids_dict, grid_index, neighbourhood, radii, thresholds)) as executor:
+        results = executor.map(_covered_grids_chunk, (xs[rows] for rows in chunks), (ys[rows] for rows in chunks))
+        for chunk_result in tqdm(results, total=len(chunks)):
+            for combo, (chunk_indptr, chunk_indices) in chunk_result.items():
+                indptr_parts[combo].append(chunk_indptr[1:] + offsets[combo])
+                indices_parts[combo].append(chunk_indices)
+                offsets[combo] += len(chunk_indices)
+
+    covered = {}
+    for combo in combos:
+        indptr = np.concatenate(indptr_parts[combo])
+        indices = np.concatenate(indices_parts[combo]) if indices_parts[combo] else np.empty(0, dtype=np.int32)
+        if positions is not None:
+            indptr, indices = expand_csr(indptr, indices, inverse.ravel())
+        covered[combo] = CoveredGrids(t, veh_id, indptr, indices, preprocessed_grids_dict.ids)
+    return covered
+
+def parallel_calculate_covered_grids(df, max_workers=None, circle_radius=50, threshold=0.5, batch_rows=BATCH_ROWS,
+                                     preprocessed_grids_dict=None, grid_index=None, cache_resolution=None):
+    return parallel_calculate_covered_grids_multi(df, [circle_radius], [threshold], max_workers, batch_rows,
+                                                  preprocessed_grids_dict, grid_index, cache_resolution)[(circle_radius, threshold)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compute the grids covered by every vehicle detection circle')
+    parser.add_argument('--trajectory', type=str, default='data/20240409202305/trajectory_pre.csv', help='Trajectory csv (t, veh_id, veh_x, veh_y, ...)')
+    parser.add_argument('--grids', type=str, default=GRIDS_PATH, help='grids_dict.pkl generated by JunctionArea')
+    parser.add_argument('--radius', type=float, nargs='+', default=[50], help='Detection radius (one or more)')
+    parser.add_argument('--threshold', type=float, nargs='+', default=[0.5], help='Minimum covered fraction of a grid (one or more)')
+    parser.add_argument('--t-start', type=float, default=1440, help='Drop trajectory rows before this time')
+    parser.add_argument('--output-dir', type=str, default='data/pkl', help='Output root, results go to {output-dir}/{radius}/')
+    parser.add_argument('--max-workers', type=int, default=16)
+    parser.add_argument('--batch-rows', type=int, default=BATCH_ROWS)
+    parser.add_argument('--cache-resolution', type=float, default=None, help='Quantize circle centres to this resolution (m) and reuse coverage of repeated positions')
+    args = parser.parse_args()
 
-    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
-        future_to_row = {executor.submit(calculate_covered_grids, row): row for _, row in df.iterrows()}
-        for future in tqdm(concurrent.futures.as_completed(future_to_row), total=len(df)):
-            row = future_to_row[future]
-            try:
-                (t, veh_id), covered_grids = future.result()
-                result_dict[(t, veh_id)] = covered_grids
-            except Exception as exc:
-                print(f"Error calculating covered grids for row {row}: {exc}")
+    import pandas as pd
+    radii = [int(radius) if float(radius).is_integer() else radius for radius in args.radius]
+    trajectory = pd.read_csv(args.trajectory)
+    trajectory = trajectory[trajectory['t'] >= args.t_start]
+    preprocessed_grids_dict, grid_index = load_grids(args.grids)
+    covered = parallel_calculate_covered_grids_multi(trajectory, radii, args.threshold, args.max_workers, args.batch_rows,
+                                                     preprocessed_grids_dict, grid_index, args.cache_resolution)
 
-    return result_dict
+    for (detection_radius, threshold), covered_grids in covered.items():
+        suffix = '' if len(args.threshold) == 1 else f'_{threshold}'
+        output_directory = os.path.join(args.output_dir, str(detection_radius))
+        os.makedirs(output_directory, exist_ok=True)
+        write_pickle(covered_grids.to_dict(), os.path.join(output_directory, f"covered_grids_pre_{detection_radius}{suffix}.pkl"))
 
 
-trajectory = pd.read_csv('data/20240409202305/trajectory_pre.csv')
-trajectory = trajectory[trajectory['t'] >= 1440]
-result_dict = parallel_calculate_covered_grids(trajectory, max_workers=16)
-# write_pickle(result_dict, "data/pkl/20/covered_grids_pre_20.pkl")
-detection_radius = 50
-write_pickle(result_dict, f"data/pkl/{detection_radius}/covered_grids_pre_{detection_radius}.pkl")
+if __name__ == "__main__":
+    # 进程池在 spawn 模式下会重新导入本模块, 计算入口需放在 main 保护内
+    main()
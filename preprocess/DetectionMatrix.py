@@ -0,0 +1,86 @@
+import numpy as np
+from utils import concat_ranges
+
+
+class DetectionMatrix:
+    # 探测张量 (栅格 × 车辆 × 时间) 的稀疏存储: 按栅格分行的 CSR, 每个非零元记录 (车辆下标, 时间下标)
+    # detection_matrix[m] 返回稠密 (车辆, 时间) 矩阵, detection_matrix[:k] 返回前 k 个栅格的子张量
+    def __init__(self, indptr, vehicle, time, shape):
+        self.indptr = np.asarray(indptr, dtype=np.int64)
+        self.vehicle = np.asarray(vehicle, dtype=np.int32)
+        self.time = np.asarray(time, dtype=np.int16)
+        self.shape = tuple(int(n) for n in shape)
+        if len(self.indptr) != self.shape[0] + 1:
+            raise ValueError(f"Invalid indptr length:{len(self.indptr)}")
+
+    @classmethod
+    def from_coo(cls, grid, vehicle, time, shape):
+        # 重复的 (栅格, 车辆, 时间) 只保留一个
+        num_grids, num_vehicles, num_periods = shape
+        flat = (np.asarray(grid, dtype=np.int64) * num_vehicles + np.asarray(vehicle, dtype=np.int64)) * num_periods + np.asarray(time, dtype=np.int64)
+        flat = np.unique(flat)
+        grid, rest = np.divmod(flat, num_vehicles * num_periods)
+        vehicle, time = np.divmod(rest, num_periods)
+        indptr = np.concatenate([[0], np.cumsum(np.bincount(grid, minlength=num_grids))])
+        return cls(indptr, vehicle, time, shape)
+
+    @classmethod
+    def from_dense(cls, dense):
+        dense = np.asarray(dense)
+        grid, vehicle, time = np.nonzero(dense)
+        return cls.from_coo(grid, vehicle, time, dense.shape)
+
+    @property
+    def nnz(self):
+        return len(self.vehicle)
+
+    @property
+    def nbytes(self):
+        return self.indptr.nbytes + self.vehicle.nbytes + self.time.nbytes
+
+    def __len__(self):
+        return self.shape[0]
+
+    def grid(self, m):
+        # 栅格 m 的非零元 (车辆下标, 时间下标)
+        start, end = self.indptr[m], self.indptr[m + 1]
+        return self.vehicle[start:end], self.time[start:end]
+
+    def take_grids(self, grid_indices):
+        grid_indices = np.asarray(grid_indices, dtype=np.int64)
+        counts = self.indptr[grid_indices + 1] - self.indptr[grid_indices]
+        entries = concat_ranges(self.indptr[grid_indices], counts)
+        indptr = np.concatenate([[0], np.cumsum(counts)])
+        return DetectionMatrix(indptr, self.vehicle[entries], self.time[entries], (len(grid_indices),) + self.shape[1:])
+
+    def __getitem__(self, key):
+        rest = ()
+        if isinstance(key, tuple):
+            key, rest = key[0], key[1:]
+        if isinstance(key, (int, np.integer)):
+            m = range(self.shape[0])[key]
+            row = np.zeros(self.shape[1:], dtype=np.int8)
+            vehicle, time = self.grid(m)
+            row[vehicle, time] = 1
+            return row[rest] if rest else row
+        sub = self.take_grids(np.arange(self.shape[0])[key])
+        if all(isinstance(k, slice) and k == slice(None) for k in rest):
+            return sub
+        # 车辆/时间维的切片回退到稠密数组
+        return sub.todense()[(slice(None),) + rest]
+
+    def todense(self, dtype=np.int8):
+        dense = np.zeros(self.shape, dtype=dtype)
+        grid = np.repeat(np.arange(self.shape[0]), np.diff(self.indptr))
+        dense[grid, self.vehicle, self.time] = 1
+        return dense
+
+    def tocsr(self):
+        # scipy.sparse 矩阵: 行为栅格, 列为 车辆 * 时间数 + 时间
+        from scipy.sparse import csr_matrix
+        num_grids, num_vehicles, num_periods = self.shape
+        columns = self.vehicle.astype(np.int64) * num_periods + self.time
+        return csr_matrix((np.ones(self.nnz, dtype=np.int8), columns, self.indptr), shape=(num_grids, num_vehicles * num_periods))
+
+    def __repr__(self):
+        return f"DetectionMatrix(shape={self.shape}, nnz={self.nnz})"
@@ -1,61 +1,226 @@
-import pandas as pd
+import os
+import argparse
+from collections import deque
 import numpy as np
 from utils import read_pickle, write_pickle
+from preprocess.DetectionMatrix import DetectionMatrix
+from preprocess.MatrixStore import write_window_matrices
 
-# data 
-entry_exit = pd.read_csv("data/csv/entry_exit.csv")
-trajectory = pd.read_csv("data/csv/entry_exit_pre.csv")
-grids_dict = read_pickle('data/pkl/grids_dict.pkl')
 
-# covered_dict
-detection_radius = 20
-# covered_dict = read_pickle("data/pkl/100/covered_grids_pre.pkl")
-covered_dict = read_pickle(f"data/pkl/{detection_radius}/covered_grids_pre_{detection_radius}.pkl")
+def flatten_covered_dict(covered_dict, grid_mapping):
+    # {(t, veh_id): [grid, ...]} -> 三列数组 (t, veh_id, grid 下标), 不在 grid_mapping 中的栅格丢弃
+    cov_t, cov_veh, cov_grid = [], [], []
+    for (t, veh_id), grids in covered_dict.items():
+        grid_indices = [grid_mapping[grid] for grid in grids if grid in grid_mapping]
+        cov_t.extend([t] * len(grid_indices))
+        cov_veh.extend([veh_id] * len(grid_indices))
+        cov_grid.extend(grid_indices)
+    return np.array(cov_t, dtype=float), np.array(cov_veh, dtype=object), np.array(cov_grid, dtype=np.int64)
 
-# matrix
-T_start = 1440
-C_duration = 30
-grid_ids = list(grids_dict.keys())
-num_grids = len(grid_ids)
+class SlidingWindowBuilder:
+    # 滑动窗口增量构建: 覆盖记录按整数时刻分组一次, 窗口前移时只追加新进入的时刻、丢弃过期时刻,
+    # 窗口内的轨迹行也只增删新进入、已离开的行 (后退或首次调用时重新筛选一次)
+    # move() 的开销与步长成正比, 返回本步的增量; advance() 另外生成完整窗口矩阵, 开销与窗口内探测次数成正比
+    def __init__(self, trajectory, grids_dict, covered_dict, C_duration=30):
+        import pandas as pd
+        grid_mapping = {grid: g for g, grid in enumerate(grids_dict)}
+        self.num_grids = len(grid_mapping)
+        self.C_duration = C_duration
 
-# 初始化探测矩阵和Injunction矩阵
-detection_matrices_list = []
-in_junction_matrices_list = []
+        # 车辆统一编码 (按轨迹中首次出现的顺序)
+        self.veh_codes, self.vehicles = pd.factorize(trajectory['veh_id'])
+        self.t_entry = trajectory['t_entry'].to_numpy(dtype=float)
+        self.t_exit = trajectory['t_exit'].to_numpy(dtype=float)
+        # 每辆车取第一条进出记录
+        first_rows = np.unique(self.veh_codes, return_index=True)[1]
+        self.first_entry = self.t_entry[first_rows]
+        self.first_exit = self.t_exit[first_rows]
 
-for i, t_start in enumerate(range(1440, 1440 + 20 * C_duration, C_duration)):
-    # 获取当前时间窗口内的车辆列表和数量
-    vehicle_ids = trajectory[(trajectory['t_entry']<=(t_start + C_duration)) & (trajectory['t_exit'] > t_start)]['veh_id'].unique()
-    # vehicle_ids = entry_exit[entry_exit['t_entry'].between(t_start, t_start + C_duration)]['veh_id'].unique()
-    num_vehicles = len(vehicle_ids)
+        # 覆盖记录按时刻分组, 只有整数时刻参与窗口
+        cov_t, cov_veh, cov_grid = flatten_covered_dict(covered_dict, grid_mapping)
+        cov_code = self.vehicles.get_indexer(cov_veh) if len(cov_veh) else np.empty(0, dtype=np.int64)
+        keep = (cov_code >= 0) & (cov_t == np.floor(cov_t))
+        cov_t, cov_code, cov_grid = cov_t[keep].astype(np.int64), cov_code[keep], cov_grid[keep]
+        order = np.argsort(cov_t, kind='stable')
+        cov_t, cov_code, cov_grid = cov_t[order], cov_code[order], cov_grid[order]
+        times, starts = np.unique(cov_t, return_index=True)
+        ends = np.append(starts[1:], len(cov_t))
+        self.timesteps = {t: (cov_grid[a:b], cov_code[a:b]) for t, a, b in zip(times.tolist(), starts, ends)}
 
-    # 初始化探测矩阵和Injunction矩阵
-    detection_matrix = np.zeros((num_grids, num_vehicles, C_duration), dtype=int)
-    in_junction_matrix = np.zeros((num_vehicles, C_duration), dtype=int)
+        # 轨迹行按进入/离开时刻各排序一次, 窗口前移时只处理新进入、已离开的行
+        self.entry_order = np.argsort(self.t_entry, kind='stable')
+        self.exit_order = np.argsort(self.t_exit, kind='stable')
+        self.entry_sorted = self.t_entry[self.entry_order]
+        self.exit_sorted = self.t_exit[self.exit_order]
+        self.active_rows = set()
+        self.entry_pointer = self.exit_pointer = 0
+        # 每辆车在窗口内的轨迹行数, 由 0 变为正数即进入窗口, 反之离开
+        self.vehicle_rows = np.zeros(len(self.vehicles), dtype=np.int64)
+        self.vehicle_ids = self.vehicles.to_numpy()
+        # 车辆编码 -> 当前窗口的列号, 只在生成窗口时重置上一窗口的车辆
+        self.position = np.full(len(self.vehicles), -1, dtype=np.int64)
+        self.window_codes = np.empty(0, dtype=np.int64)
 
-    vehicle_mapping = {veh_id: j for j, veh_id in enumerate(vehicle_ids)}
-    time_mapping = {t: t - t_start for t in range(t_start, t_start + C_duration)}
+        self.blocks = deque()
+        self.t_start = None
 
-    # 填充探测矩阵
-    for (t, veh_id), grids in covered_dict.items():
-        if veh_id in vehicle_mapping and t in time_mapping:
-            time_idx = time_mapping[t]
-            vehicle_idx = vehicle_mapping[veh_id]
-            for grid in grids:
-                if grid in grid_ids:
-                    grid_idx = grid_ids.index(grid)
-                    detection_matrix[grid_idx, vehicle_idx, time_idx] = 1
-
-    # 填充Injunction矩阵
-    for t in range(t_start, t_start + C_duration):
-        for j, veh_id in enumerate(vehicle_ids):
-            entry_time, exit_time = trajectory[trajectory['veh_id'] == veh_id][['t_entry', 't_exit']].iloc[0]
-            if entry_time <= t <= exit_time:
-                in_junction_matrix[j, t - t_start] = 1
-
-    # 将当前时间窗口的探测矩阵和Injunction矩阵添加到列表中
-    detection_matrices_list.append(detection_matrix)
-    in_junction_matrices_list.append(in_junction_matrix)
-
-
-write_pickle(detection_matrices_list, f"data/pkl/{detection_radius}/detection_matrices_pre_{detection_radius}.pkl")
-write_pickle(in_junction_matrices_list, f"data/pkl/{detection_radius}/in_junction_matrices_pre_{detection_radius}.pkl")
+    def _push(self, t):
+        grid, code = self.timesteps.get(t, (np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)))
+        self.blocks.append((t, grid, code))
+        return self.blocks[-1]
+
+    def _update_rows(self, t_start):
+        # 窗口内的轨迹行: t_entry <= t_start + C_duration 且 t_exit > t_start
+        entry_pointer = np.searchsorted(self.entry_sorted, t_start + self.C_duration, side='right')
+        exit_pointer = np.searchsorted(self.exit_sorted, t_start, side='right')
+        if self.t_start is None or t_start < self.t_start:
+            # 首次或后退: 在较短的一侧候选行中重新筛选
+            if entry_pointer <= len(self.exit_order) - exit_pointer:
+                rows = self.entry_order[:entry_pointer]
+                rows = rows[self.t_exit[rows] > t_start]
+            else:
+                rows = self.exit_order[exit_pointer:]
+                rows = rows[self.t_entry[rows] <= t_start + self.C_duration]
+            rows = set(rows.tolist())
+            added, removed = rows - self.active_rows, self.active_rows - rows
+            self.active_rows = rows
+        else:
+            # 前移: 加入新进入的行, 删除已离开的行
+            entering = self.entry_order[self.entry_pointer:entry_pointer]
+            added = set(entering[self.t_exit[entering] > t_start].tolist()) - self.active_rows
+            self.active_rows.update(added)
+            removed = self.active_rows.intersection(self.exit_order[self.exit_pointer:exit_pointer].tolist())
+            self.active_rows.difference_update(removed)
+        self.entry_pointer, self.exit_pointer = entry_pointer, exit_pointer
+        return self._update_vehicles(np.fromiter(added, dtype=np.int64, count=len(added)),
+                                     np.fromiter(removed, dtype=np.int64, count=len(removed)))
+
+    def _update_vehicles(self, added_rows, removed_rows):
+        # 返回 (进入窗口的车辆编码, 离开窗口的车辆编码)
+        touched = np.unique(self.veh_codes[np.concatenate([added_rows, removed_rows])])
+        before = self.vehicle_rows[touched] > 0
+        np.add.at(self.vehicle_rows, self.veh_codes[added_rows], 1)
+        np.subtract.at(self.vehicle_rows, self.veh_codes[removed_rows], 1)
+        after = self.vehicle_rows[touched] > 0
+        return touched[after & ~before], touched[before & ~after]
+
+    def move(self, t_start):
+        # 窗口移动到 [t_start, t_start + C_duration), 与上一窗口重叠的时刻直接复用, 不生成窗口矩阵
+        # 返回本步增量: added 为新进入的时刻块 (t, 栅格下标, 车辆 ID), 含窗口外车辆的探测, 使用时按当前窗口车辆筛选;
+        # dropped 为丢弃的时刻; entered / left 为进入、离开窗口的车辆 ID
+        t_end = t_start + self.C_duration
+        entered, left = self._update_rows(t_start)
+        if self.t_start is None or t_start < self.t_start or t_start >= self.t_start + self.C_duration:
+            dropped = [block[0] for block in self.blocks]
+            self.blocks.clear()
+            first_new = t_start
+        else:
+            dropped = []
+            while self.blocks and self.blocks[0][0] < t_start:
+                dropped.append(self.blocks.popleft()[0])
+            first_new = self.t_start + self.C_duration
+        added = [self._push(t) for t in range(first_new, t_end)]
+        self.t_start = t_start
+        return {
+            't_start': t_start,
+            'added': [(t, grid, self.vehicle_ids[code]) for t, grid, code in added],
+            'dropped': dropped,
+            'entered': self.vehicle_ids[entered].tolist(),
+            'left': self.vehicle_ids[left].tolist(),
+        }
+
+    def advance(self, t_start):
+        self.move(t_start)
+        return self.window()
+
+    def window(self):
+        # 完整窗口矩阵: 开销与窗口内的车辆数、探测次数成正比 (一次列号映射和一次 from_coo 排序), 不扫描整条轨迹;
+        # 只需逐步更新的调用方使用 move() / deltas() 返回的增量
+        import pandas as pd
+        t_start, C_duration = self.t_start, self.C_duration
+        # 获取当前时间窗口内的车辆列表和数量 (按轨迹中的行顺序)
+        rows = np.fromiter(sorted(self.active_rows), dtype=np.int64, count=len(self.active_rows))
+        window_codes = pd.unique(self.veh_codes[rows])
+        num_vehicles = len(window_codes)
+        self.position[self.window_codes] = -1
+        self.position[window_codes] = np.arange(num_vehicles)
+        self.window_codes = window_codes
+
+        # 填充探测矩阵 (稀疏存储, 内存与探测次数成正比)
+        grid = np.concatenate([block[1] for block in self.blocks])
+        vehicle_idx = self.position[np.concatenate([block[2] for block in self.blocks])]
+        time_idx = np.repeat([block[0] - t_start for block in self.blocks], [len(block[1]) for block in self.blocks])
+        keep = vehicle_idx >= 0
+        detection_matrix = DetectionMatrix.from_coo(grid[keep], vehicle_idx[keep], time_idx[keep],
+                                                    (self.num_grids, num_vehicles, C_duration))
+
+        # 填充Injunction矩阵
+        times = np.arange(t_start, t_start + C_duration)
+        entry_time = self.first_entry[window_codes][:, None]
+        exit_time = self.first_exit[window_codes][:, None]
+        in_junction_matrix = ((entry_time <= times) & (times <= exit_time)).astype(np.int8)
+
+        return self.vehicles[window_codes].tolist(), detection_matrix, in_junction_matrix
+
+    def windows(self, T_start, num_windows, stride=None):
+        stride = stride or self.C_duration
+        for k in range(num_windows):
+            yield self.advance(T_start + k * stride)
+
+    def deltas(self, T_start, num_windows, stride=None):
+        stride = stride or self.C_duration
+        for k in range(num_windows):
+            yield self.move(T_start + k * stride)
+
+def generate_window_matrices(trajectory, grids_dict, covered_dict, T_start=1440, C_duration=30, num_windows=20, stride=None):
+    # stride 缺省等于 C_duration (互不重叠的窗口)
+    detection_matrices_list = []
+    in_junction_matrices_list = []
+    vehicle_ids_list = []
+    builder = SlidingWindowBuilder(trajectory, grids_dict, covered_dict, C_duration)
+    for vehicle_ids, detection_matrix, in_junction_matrix in builder.windows(T_start, num_windows, stride):
+        detection_matrices_list.append(detection_matrix)
+        in_junction_matrices_list.append(in_junction_matrix)
+        vehicle_ids_list.append(vehicle_ids)
+    return detection_matrices_list, in_junction_matrices_list, vehicle_ids_list
+
+def main():
+    parser = argparse.ArgumentParser(description='Build per-window detection and in-junction matrices')
+    parser.add_argument('--trajectory', type=str, default='data/csv/entry_exit_pre.csv', help='Entry/exit csv (veh_id, t_entry, t_exit)')
+    parser.add_argument('--grids', type=str, default='data/pkl/grids_dict.pkl', help='grids_dict.pkl generated by JunctionArea')
+    parser.add_argument('--radius', type=int, default=20, help='Detection radius of the covered grids file')
+    parser.add_argument('--covered', type=str, default=None, help='Covered grids pickle, defaults to {output-dir}/{radius}/covered_grids_pre_{radius}.pkl')
+    parser.add_argument('--t-start', type=int, default=1440, help='Start time of the first window')
+    parser.add_argument('--duration', type=int, default=30, help='Window length C_duration')
+    parser.add_argument('--num-windows', type=int, default=20)
+    parser.add_argument('--stride', type=int, default=None, help='Offset between consecutive window starts, defaults to --duration')
+    parser.add_argument('--output-dir', type=str, default='data/pkl')
+    parser.add_argument('--format', type=str, default='npy', choices=['npy', 'pkl'], help='npy: per-window memory-mapped store, pkl: pickled window lists')
+    args = parser.parse_args()
+
+    import pandas as pd
+    detection_radius = args.radius
+    output_directory = os.path.join(args.output_dir, str(detection_radius))
+    # data
+    trajectory = pd.read_csv(args.trajectory)
+    grids_dict = read_pickle(args.grids)
+    # covered_dict
+    covered_dict = read_pickle(args.covered or os.path.join(output_directory, f"covered_grids_pre_{detection_radius}.pkl"))
+
+    detection_matrices_list, in_junction_matrices_list, vehicle_ids_list = generate_window_matrices(
+        trajectory, grids_dict, covered_dict, args.t_start, args.duration, args.num_windows, args.stride)
+
+    if args.format == 'npy':
+        stride = args.stride or args.duration
+        t_starts = [args.t_start + k * stride for k in range(args.num_windows)]
+        write_window_matrices(os.path.join(output_directory, f"window_matrices_pre_{detection_radius}"),
+                              detection_matrices_list, in_junction_matrices_list, vehicle_ids_list, t_starts)
+    elif args.format == 'pkl':
+        write_pickle(detection_matrices_list, os.path.join(output_directory, f"detection_matrices_pre_{detection_radius}.pkl"))
+        write_pickle(in_junction_matrices_list, os.path.join(output_directory, f"in_junction_matrices_pre_{detection_radius}.pkl"))
+    else:
+        raise ValueError(f"Invalid format:{args.format}")
+
+
+if __name__ == "__main__":
+    main()
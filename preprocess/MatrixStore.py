@@ -0,0 +1,87 @@
+import os
+import numpy as np
+from utils import read_pickle, write_pickle
+from preprocess.DetectionMatrix import DetectionMatrix
+
+
+MANIFEST_NAME = 'matrix_manifest.pkl'
+WINDOW_ARRAYS = ('indptr', 'vehicle', 'time', 'in_junction', 'vehicle_ids')
+
+
+def write_window_matrices(output_directory, detection_matrices, in_junction_matrices, vehicle_ids_list, t_starts=None):
+    # 每个时间窗口一组 .npy (window_{k}_{name}.npy) + 清单 matrix_manifest.pkl
+    os.makedirs(output_directory, exist_ok=True)
+    windows = []
+    for k, (detection_matrix, in_junction_matrix, vehicle_ids) in enumerate(zip(detection_matrices, in_junction_matrices, vehicle_ids_list)):
+        if not isinstance(detection_matrix, DetectionMatrix):
+            detection_matrix = DetectionMatrix.from_dense(detection_matrix)
+        arrays = {
+            'indptr': detection_matrix.indptr,
+            'vehicle': detection_matrix.vehicle,
+            'time': detection_matrix.time,
+            'in_junction': np.asarray(in_junction_matrix, dtype=np.int8),
+            # 定长字符串/数值数组, 可直接 mmap
+            'vehicle_ids': np.array(list(vehicle_ids)),
+        }
+        files = {}
+        for name in WINDOW_ARRAYS:
+            files[name] = f'window_{k}_{name}.npy'
+            np.save(os.path.join(output_directory, files[name]), arrays[name])
+        windows.append({
+            'window': k,
+            't_start': None if t_starts is None else t_starts[k],
+            'shape': detection_matrix.shape,
+            'nnz': detection_matrix.nnz,
+            'files': files,
+        })
+    write_pickle({'windows': windows}, os.path.join(output_directory, MANIFEST_NAME))
+
+class WindowSequence:
+    # 按下标惰性加载窗口, 供 optimize_all_window_vehicle_selection 这类按 i 取值的代码直接使用
+    def __init__(self, loader, length):
+        self.loader = loader
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, k):
+        return self.loader(range(self.length)[k])
+
+class WindowMatrixStore:
+    # 读取 write_window_matrices 的输出; 单个窗口以 mmap 打开, 不读取其他窗口
+    def __init__(self, output_directory, mmap_mode='r'):
+        self.output_directory = output_directory
+        self.mmap_mode = mmap_mode
+        self.manifest = read_pickle(os.path.join(output_directory, MANIFEST_NAME))
+        self.windows = self.manifest['windows']
+
+    def __len__(self):
+        return len(self.windows)
+
+    def _load(self, k, name):
+        return np.load(os.path.join(self.output_directory, self.windows[k]['files'][name]), mmap_mode=self.mmap_mode)
+
+    def detection_matrix(self, k, grids=None):
+        # grids: 可选栅格切片 (如 slice(None, 1260)), 只复制所选栅格的非零元
+        entry = self.windows[k]
+        detection_matrix = DetectionMatrix(self._load(k, 'indptr'), self._load(k, 'vehicle'), self._load(k, 'time'), entry['shape'])
+        return detection_matrix if grids is None else detection_matrix[grids]
+
+    def in_junction_matrix(self, k):
+        return self._load(k, 'in_junction')
+
+    def vehicle_ids(self, k):
+        return self._load(k, 'vehicle_ids').tolist()
+
+    def window(self, k, grids=None):
+        return self.vehicle_ids(k), self.detection_matrix(k, grids), self.in_junction_matrix(k)
+
+    def detection_matrices(self, grids=None):
+        return WindowSequence(lambda k: self.detection_matrix(k, grids), len(self))
+
+    def in_junction_matrices(self):
+        return WindowSequence(self.in_junction_matrix, len(self))
+
+    def vehicle_ids_list(self):
+        return WindowSequence(self.vehicle_ids, len(self))
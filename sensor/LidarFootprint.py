@@ -0,0 +1,28 @@
+import numpy as np
+from LiDAR.LidarPosition import calculate_lidar_position
+
+
+def lidar_ground_rings(lidar, mount_height):
+    # 各垂直通道的水平覆盖区间 [cos(v)*r_min, cos(v)*r_max], 向下的通道在触地处截止, 合并为环带集合
+    if lidar.horizontal_fov < 360:
+        raise ValueError(f"Analytic footprint requires a 360° horizontal fov, got {lidar.horizontal_fov}")
+    angles_v = np.radians(np.linspace(lidar.vertical_fov[0], lidar.vertical_fov[1], lidar.num_channels))
+    inner = np.cos(angles_v) * lidar.range_min
+    outer = np.cos(angles_v) * lidar.range_max
+    down = angles_v < 0
+    outer[down] = np.minimum(outer[down], mount_height / np.tan(-angles_v[down]))
+
+    rings = []
+    for r_in, r_out in sorted(zip(inner[outer > inner], outer[outer > inner])):
+        if rings and r_in <= rings[-1][1]:
+            rings[-1] = (rings[-1][0], max(rings[-1][1], float(r_out)))
+        else:
+            rings.append((float(r_in), float(r_out)))
+    return rings
+
+def lidar_ground_footprint(lidar, veh_x, veh_y, veh_len, veh_wid, veh_hig, lidar_pos):
+    sensor_x, sensor_y, sensor_z = calculate_lidar_position(veh_x, veh_y, veh_len, veh_wid, veh_hig, lidar_pos)
+    return (sensor_x, sensor_y), lidar_ground_rings(lidar, sensor_z)
+
+def footprint_area(rings):
+    return sum(np.pi * (r_out**2 - r_in**2) for r_in, r_out in rings)
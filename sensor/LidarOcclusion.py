@@ -0,0 +1,129 @@
+import numpy as np
+from matplotlib.path import Path
+from area_shape.CoverageArea import polygon_bounds, is_axis_aligned_rectangle
+from utils import concat_ranges
+
+
+EPSILON = 1e-8
+# 角度分桶数 (0.5°)
+NUM_ANGLE_BUCKETS = 720
+
+
+def vehicle_boxes(veh_x, veh_y, veh_len, veh_wid, veh_hig, veh_ang=None):
+    # 车辆包围盒, veh_ang 为 SUMO 角度 (正北为 0, 顺时针), 缺省时车身沿 Y 轴
+    veh_x, veh_y, veh_len, veh_wid, veh_hig = np.broadcast_arrays(
+        *(np.atleast_1d(np.asarray(v, dtype=float)) for v in (veh_x, veh_y, veh_len, veh_wid, veh_hig)))
+    angle = np.zeros_like(veh_x) if veh_ang is None else np.radians(np.broadcast_to(np.asarray(veh_ang, dtype=float), veh_x.shape))
+    return {
+        "cx": veh_x,
+        "cy": veh_y,
+        "half_len": veh_len / 2,
+        "half_wid": veh_wid / 2,
+        "height": veh_hig,
+        "sin": np.sin(angle),
+        "cos": np.cos(angle),
+    }
+
+def _to_box_frame(boxes, box_ids, dx, dy):
+    # 世界坐标 -> 包围盒坐标 (u 沿车长, v 沿车宽)
+    sin_a, cos_a = boxes["sin"][box_ids], boxes["cos"][box_ids]
+    return dx * sin_a + dy * cos_a, dx * cos_a - dy * sin_a
+
+def _box_corners(boxes):
+    u = np.stack([boxes["sin"], boxes["cos"]], axis=-1) * boxes["half_len"][:, None]
+    v = np.stack([boxes["cos"], -boxes["sin"]], axis=-1) * boxes["half_wid"][:, None]
+    center = np.stack([boxes["cx"], boxes["cy"]], axis=-1)
+    return np.stack([center + u + v, center + u - v, center - u - v, center - u + v], axis=1)
+
+class AngularBucketIndex:
+    # 以传感器为极点的均匀角度网格: 每个角度桶记录与之相交的包围盒 (CSR)
+    def __init__(self, origin, boxes, box_ids, num_buckets=NUM_ANGLE_BUCKETS):
+        self.origin = origin
+        self.num_buckets = num_buckets
+        self.bucket_width = 2 * np.pi / num_buckets
+
+        corners = _box_corners({key: value[box_ids] for key, value in boxes.items()})
+        rel = corners - np.asarray(origin[:2], dtype=float)
+        corner_angles = np.arctan2(rel[..., 1], rel[..., 0])
+        center_angles = np.arctan2(rel[..., 1].mean(axis=1), rel[..., 0].mean(axis=1))
+        offsets = (corner_angles - center_angles[:, None] + np.pi) % (2 * np.pi) - np.pi
+        first = self._bucket(center_angles + offsets.min(axis=1))
+        last = self._bucket(center_angles + offsets.max(axis=1))
+        counts = (last - first) % num_buckets + 1
+
+        # 传感器位于包围盒内时覆盖全部角度
+        u, v = _to_box_frame(boxes, box_ids, origin[0] - boxes["cx"][box_ids], origin[1] - boxes["cy"][box_ids])
+        contains_origin = (np.abs(u) <= boxes["half_len"][box_ids]) & (np.abs(v) <= boxes["half_wid"][box_ids])
+        counts[contains_origin] = num_buckets
+        first[contains_origin] = 0
+
+        entry_box = np.repeat(box_ids, counts)
+        entry_bucket = concat_ranges(first, counts) % num_buckets
+        order = np.argsort(entry_bucket, kind="stable")
+        self.box_ids = entry_box[order]
+        self.indptr = np.concatenate([[0], np.cumsum(np.bincount(entry_bucket, minlength=num_buckets))])
+
+    def _bucket(self, angles):
+        return (np.floor((angles + np.pi) / self.bucket_width).astype(np.int64)) % self.num_buckets
+
+    def candidate_pairs(self, targets):
+        rel = targets[:, :2] - np.asarray(self.origin[:2], dtype=float)
+        buckets = self._bucket(np.arctan2(rel[:, 1], rel[:, 0]))
+        counts = self.indptr[buckets + 1] - self.indptr[buckets]
+        target_ids = np.repeat(np.arange(len(targets)), counts)
+        box_ids = self.box_ids[concat_ranges(self.indptr[buckets], counts)]
+        return target_ids, box_ids
+
+def segment_box_hits(origin, targets, boxes, box_ids):
+    # 线段 origin -> targets 与包围盒的 slab 相交测试, 逐对向量化
+    origin = np.asarray(origin, dtype=float)
+    o_u, o_v = _to_box_frame(boxes, box_ids, origin[0] - boxes["cx"][box_ids], origin[1] - boxes["cy"][box_ids])
+    d_u, d_v = _to_box_frame(boxes, box_ids, targets[:, 0] - origin[0], targets[:, 1] - origin[1])
+    o_z = np.full_like(o_u, origin[2])
+    d_z = targets[:, 2] - origin[2]
+
+    t_enter = np.full_like(o_u, -np.inf)
+    t_exit = np.full_like(o_u, np.inf)
+    half_len, half_wid = boxes["half_len"][box_ids], boxes["half_wid"][box_ids]
+    slabs = ((o_u, d_u, -half_len, half_len),
+             (o_v, d_v, -half_wid, half_wid),
+             (o_z, d_z, np.zeros_like(o_u), boxes["height"][box_ids]))
+    for o, d, lo, hi in slabs:
+        parallel = np.abs(d) < EPSILON
+        with np.errstate(divide="ignore", invalid="ignore"):
+            t1 = (lo - o) / d
+            t2 = (hi - o) / d
+        inside = (o >= lo) & (o <= hi)
+        t_enter = np.maximum(t_enter, np.where(parallel, np.where(inside, -np.inf, np.inf), np.minimum(t1, t2)))
+        t_exit = np.minimum(t_exit, np.where(parallel, np.where(inside, np.inf, -np.inf), np.maximum(t1, t2)))
+    return (t_enter < t_exit) & (t_exit > EPSILON) & (t_enter < 1 - EPSILON)
+
+def occluded_targets(origin, targets, boxes, exclude=None, num_buckets=NUM_ANGLE_BUCKETS):
+    # targets: (N, 3) 目标点, 返回被任一车辆遮挡的布尔数组
+    targets = np.asarray(targets, dtype=float)
+    occluded = np.zeros(len(targets), dtype=bool)
+    box_ids = np.arange(len(boxes["cx"]))
+    if exclude is not None:
+        box_ids = np.setdiff1d(box_ids, np.atleast_1d(exclude))
+    if not len(box_ids) or not len(targets):
+        return occluded
+
+    index = AngularBucketIndex(origin, boxes, box_ids, num_buckets)
+    target_ids, pair_box_ids = index.candidate_pairs(targets)
+    hits = segment_box_hits(origin, targets[target_ids], boxes, pair_box_ids)
+    occluded[target_ids[hits]] = True
+    return occluded
+
+def lane_sample_points(lane_dict, sample_step=0.5):
+    # 车道内以 sample_step 为间距的网格中心采样点, 返回 (点, 车道名列表中的序号)
+    points, labels = [], []
+    for k, polygon in enumerate(lane_dict.values()):
+        left, bottom, right, top = polygon_bounds(polygon)
+        xs = np.arange(left + sample_step / 2, right, sample_step)
+        ys = np.arange(bottom + sample_step / 2, top, sample_step)
+        lane_points = np.stack(np.meshgrid(xs, ys), axis=-1).reshape(-1, 2)
+        if not is_axis_aligned_rectangle(polygon):
+            lane_points = lane_points[Path(polygon).contains_points(lane_points)]
+        points.append(lane_points)
+        labels.append(np.full(len(lane_points), k))
+    return np.concatenate(points), np.concatenate(labels)
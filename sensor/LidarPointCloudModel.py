@@ -1,33 +1,26 @@
+from functools import lru_cache
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
-from math import cos, sin, radians
 from shapely.geometry import Polygon
 from shapely.ops import unary_union
 from shapely.ops import cascaded_union
 from LiDAR.Lidar import LiDARTypes
 from LiDAR.LidarPosition import LIDARPosition, calculate_lidar_position
-from utils import read_pickle
+from LiDAR.LidarOcclusion import vehicle_boxes, occluded_targets, lane_sample_points
+from utils import read_pickle, TrajectoryIndex, lookup_vehicle, search_all_vehicle
 
 
 EPSILON = 1e-8
+# 点云模板缓存上限 (LiDAR型号 × 安装位置 × 车型)
+TEMPLATE_CACHE_SIZE = 32
 
 
 def vehicle_info(t, veh_id, data):
-    row = data[(data['t'] == t) & (data['veh_id'] == veh_id)]
-    if not row.empty:
-        return row.iloc[0][[2,3,6]] # x y lane
-    else:
+    row = lookup_vehicle(data, t, veh_id, ['veh_x', 'veh_y', 'veh_lane']) # x y lane
+    if row is None:
         print(f"Vehicle {veh_id} not found at time {t}.")
-        return None
-
-def search_all_vehicle(t, data):
-    all_vehicle_pos_at_t = []
-    all_vehicle_at_t = data[data['t'] == t]
-    if len(all_vehicle_at_t):
-        for row in all_vehicle_at_t.itertuples():
-            all_vehicle_pos_at_t.append((row.veh_x, row.veh_y))
-    return all_vehicle_pos_at_t
+    return row
 
 def scale_round_coords(coords, precision=1):
     scale_factor = 10 ** precision
@@ -84,29 +77,80 @@ class GridMap:
         print("最终的交集多边形的坐标:", list(final_intersection.exterior.coords))
         print("最终的交集多边形的面积:", final_intersection.area)
 
-    def occlusion(self, lane_dict):
-        pass
-
+    def occlusion(self, lane_dict, lidar, lidar_pos=LIDARPosition.FRONT_CENTER, sample_step=0.5):
+        # 传感器到车道采样点的视线被 t 时刻其他车辆包围盒遮挡时, 该采样点不计入可见面积
+        if isinstance(self.data, TrajectoryIndex):
+            frame = self.data.at_time(self.t)
+        else:
+            frame = {name: column.to_numpy() for name, column in self.data[self.data['t'] == self.t].items()}
+        boxes = vehicle_boxes(frame['veh_x'], frame['veh_y'], frame['veh_len'], frame['veh_wid'], frame['veh_hig'], frame.get('veh_ang'))
+        ego = np.flatnonzero(frame['veh_id'] == self.veh_id)
+        if not len(ego):
+            print(f"Vehicle {self.veh_id} not found at time {self.t}.")
+            return None
+        ego_row = {name: column[ego[0]] for name, column in frame.items()}
+        sensor_pos = calculate_lidar_position(ego_row['veh_x'], ego_row['veh_y'], ego_row['veh_len'],
+                                              ego_row['veh_wid'], ego_row['veh_hig'], lidar_pos)
+
+        points, labels = lane_sample_points(lane_dict, sample_step)
+        in_range = np.hypot(points[:, 0] - sensor_pos[0], points[:, 1] - sensor_pos[1]) <= lidar.range_max
+        points, labels = points[in_range], labels[in_range]
+        targets = np.column_stack([points, np.zeros(len(points))])
+        occluded = occluded_targets(np.array(sensor_pos, dtype=float), targets, boxes, exclude=ego)
+
+        cell_area = sample_step ** 2
+        lanes = list(lane_dict.keys())
+        visible_counts = np.bincount(labels[~occluded], minlength=len(lanes))
+        occluded_counts = np.bincount(labels[occluded], minlength=len(lanes))
+        self.visible_area = {lane: visible_counts[k] * cell_area for k, lane in enumerate(lanes)}
+        self.occluded_area = {lane: occluded_counts[k] * cell_area for k, lane in enumerate(lanes)}
+        return self.visible_area
+
+
+def lidar_ray_directions(lidar):
+    # 单位方向向量, 顺序为 水平角 × 垂直通道
+    angles_h = np.radians(np.arange(0, lidar.horizontal_fov, lidar.horizontal_resolution))
+    angles_v = np.radians(np.linspace(lidar.vertical_fov[0], lidar.vertical_fov[1], lidar.num_channels))
+    cos_v = np.cos(angles_v)
+    directions = np.empty((len(angles_h), len(angles_v), 3))
+    directions[..., 0] = np.sin(angles_h)[:, None] * cos_v[None, :]
+    directions[..., 1] = np.cos(angles_h)[:, None] * cos_v[None, :]
+    directions[..., 2] = np.sin(angles_v)[None, :]
+    return directions.reshape(-1, 3)
+
+def lidar_range_samples(lidar):
+    # for r in np.linspace(lidar.range_min, lidar.range_max, int(lidar.range_max / (1 + abs(angle_v)/10))):
+    return np.linspace(lidar.range_min, lidar.range_max, int((lidar.range_max - lidar.range_min) / 10))
+
+@lru_cache(maxsize=TEMPLATE_CACHE_SIZE)
+def lidar_point_offsets(lidar):
+    # 相对传感器的点偏移 (H*V*R, 3), 顺序与逐点循环一致: 水平角 -> 垂直通道 -> 距离采样
+    directions = lidar_ray_directions(lidar)
+    scale = 1 + lidar_range_samples(lidar)
+    offsets = directions[:, None, :] * scale[None, :, None]
+    offsets = offsets.reshape(-1, 3).astype(np.float32)
+    offsets.setflags(write=False)
+    return offsets
+
+@lru_cache(maxsize=TEMPLATE_CACHE_SIZE)
+def lidar_point_template(lidar, lidar_pos, veh_len, veh_wid, veh_hig):
+    # 以车辆位置 (0, 0) 为原点的只读点云模板, 单车点云只需平移
+    sensor_pos = calculate_lidar_position(0.0, 0.0, veh_len, veh_wid, veh_hig, lidar_pos)
+    template = lidar_point_offsets(lidar) + np.array(sensor_pos, dtype=np.float32)
+    template.setflags(write=False)
+    return template
 
 def simulate_lidar_points(lidar, veh_x, veh_y, veh_len, veh_wid, veh_hig, lidar_pos):
-    sensor_pos = calculate_lidar_position(veh_x, veh_y, veh_len, veh_wid, veh_hig, lidar_pos)
-    sensor_pos = np.array(sensor_pos,dtype=np.float32)
-    points = []
-    vertical_angles = np.linspace(lidar.vertical_fov[0], lidar.vertical_fov[1], lidar.num_channels)
-    for angle_h in np.arange(0, lidar.horizontal_fov, lidar.horizontal_resolution):
-        for angle_v in vertical_angles:
-            direction = np.array([
-                cos(radians(angle_v)) * sin(radians(angle_h)),
-                cos(radians(angle_v)) * cos(radians(angle_h)),
-                sin(radians(angle_v))
-            ])
-            # for r in np.linspace(lidar.range_min, lidar.range_max, int(lidar.range_max / (1 + abs(angle_v)/10))):
-            for r in np.linspace(lidar.range_min, lidar.range_max, int((lidar.range_max-lidar.range_min)/10)):
-                point = sensor_pos + direction + direction * r
-                points.append(point)
-    
-    return np.array(points)
+    template = lidar_point_template(lidar, lidar_pos, float(veh_len), float(veh_wid), float(veh_hig))
+    return template + np.array([veh_x, veh_y, 0], dtype=np.float32)
 
+def simulate_lidar_points_batch(lidar, veh_x, veh_y, veh_len, veh_wid, veh_hig, lidar_pos):
+    # 批量车辆位姿 -> (N, H*V*R, 3)
+    veh_x, veh_y, veh_len, veh_wid, veh_hig = np.broadcast_arrays(
+        *(np.atleast_1d(np.asarray(v, dtype=np.float32)) for v in (veh_x, veh_y, veh_len, veh_wid, veh_hig)))
+    sensor_pos = calculate_lidar_position(veh_x, veh_y, veh_len, veh_wid, veh_hig, lidar_pos)
+    sensor_pos = np.stack(np.broadcast_arrays(*sensor_pos), axis=-1).astype(np.float32)
+    return lidar_point_offsets(lidar)[None, :, :] + sensor_pos[:, None, :]
 
 if __name__ == '__main__':
     # ------------------lidar simulation------------------
@@ -123,10 +167,9 @@ if __name__ == '__main__':
     plt.show()
 
     # ------------------grids simulation------------------
-    # data = pd.read_csv('data/202403291546/sumoTrace_veh_type.csv')
-    # del data['Unnamed: 0']
+    # data = TrajectoryIndex.from_csv('data/202403291546/sumoTrace_veh_type.csv')
     # lane_dict = read_pickle('data/pkl/lane_dict.pkl')
-    # test_t = data.iloc[0, 0]
-    # test_veh_id = data.iloc[0, 1]
+    # test_t = data.t[0]
+    # test_veh_id = data.veh_id[0]
     # test_grids = GridMap(test_veh_id, test_t, data, 4.6)
     # test_grids.generate_grids(LiDARTypes.Test1, lane_dict)
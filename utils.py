@@ -1,4 +1,5 @@
 import pickle
+import numpy as np
 
 def save_dict(obj, path):
     assert path.endswith('.pkl'), "path must ends with .pkl"
@@ -18,7 +19,75 @@ def read_pickle(path):
     with open(path, 'rb') as f:
         return pickle.load(f)
 
+def concat_ranges(starts, counts):
+    # 拼接 [s0, s0+c0), [s1, s1+c1), ... 的向量化实现
+    starts, counts = np.asarray(starts, dtype=np.int64), np.asarray(counts, dtype=np.int64)
+    offsets = np.repeat(np.cumsum(counts) - counts, counts)
+    return np.repeat(starts, counts) + np.arange(counts.sum()) - offsets
+
+class TrajectoryIndex:
+    # 按 (t, veh_id) 排序的轨迹列存储, (t, veh_id) -> 行号为哈希查找, 按时间取行为二分查找
+    def __init__(self, data):
+        data = data.sort_values(by=['t', 'veh_id'], kind='stable').reset_index(drop=True)
+        self.columns = {name: data[name].to_numpy() for name in data.columns}
+        self.t = self.columns['t']
+        self.veh_id = self.columns['veh_id']
+        keys = list(zip(self.t.tolist(), self.veh_id.tolist()))
+        # 重复的 (t, veh_id) 取第一行
+        self._rows = dict(zip(reversed(keys), range(len(keys) - 1, -1, -1)))
+        self._keys = list(dict.fromkeys(keys))
+        self.times = np.unique(self.t)
+
+    @classmethod
+    def from_csv(cls, path):
+        import pandas as pd
+        data = pd.read_csv(path, index_col=None)
+        if 'Unnamed: 0' in data.columns:
+            del data['Unnamed: 0']
+        return cls(data)
+
+    def __len__(self):
+        return len(self.t)
+
+    def __contains__(self, key):
+        return key in self._rows
+
+    def keys(self):
+        return self._keys
+
+    def row_index(self, t, veh_id):
+        return self._rows.get((t, veh_id))
+
+    def row(self, t, veh_id, columns=None):
+        i = self.row_index(t, veh_id)
+        if i is None:
+            return None
+        return {name: self.columns[name][i] for name in (columns or self.columns)}
+
+    def time_slice(self, t_start, t_end=None):
+        # [t_start, t_end] 时间范围内的连续行
+        start = np.searchsorted(self.t, t_start, side='left')
+        stop = np.searchsorted(self.t, t_start if t_end is None else t_end, side='right')
+        return slice(start, stop)
+
+    def at_time(self, t, columns=None):
+        rows = self.time_slice(t)
+        return {name: self.columns[name][rows] for name in (columns or self.columns)}
+
+def lookup_vehicle(data, t, veh_id, columns=None):
+    # 兼容 TrajectoryIndex 与 DataFrame 的单行查询
+    if isinstance(data, TrajectoryIndex):
+        return data.row(t, veh_id, columns)
+    row = data[(data['t'] == t) & (data['veh_id'] == veh_id)]
+    if row.empty:
+        return None
+    row = row.iloc[0]
+    return {name: row[name] for name in (columns or row.index)}
+
 def search_all_vehicle(t, data):
+    if isinstance(data, TrajectoryIndex):
+        at_t = data.at_time(t, ['veh_x', 'veh_y'])
+        return list(zip(at_t['veh_x'].tolist(), at_t['veh_y'].tolist()))
     all_vehicle_pos_at_t = []
     all_vehicle_at_t = data[data['t'] == t]
     if len(all_vehicle_at_t):